@@ -0,0 +1,338 @@
+import argparse
+import csv
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import evaluate
+import text_store
+import token_index
+
+"""
+  Benchmarks for the scoring pipeline in evaluate.py
+
+  A synthetic corpus is generated from the real texts, at some multiple of the size of gsml.csv:
+  - texts/ holds `scale` copies of every text in the base text_dir (S001_0000, S001_0001, ...)
+  - the token lookup is derived from those texts (see token_index.index_from_texts()), with yaml
+    token_lookup.yaml is written too, so that compiling and loading it can be timed
+  - gsml.csv has spans_per_text mistakes in each text
+  - submission.csv has the same number of mistakes in each text, a fraction (overlap) of which overlap
+    a GSML mistake, the rest are placed on tokens without one
+  Span lengths are drawn uniformly from 1 to 2*span_length-1 tokens (and end at the end of a sentence).
+  Each stage is then timed on that corpus, and the timings are written as JSON, e.g.
+
+    python benchmark.py --scale=10 --out=bench.json
+    python benchmark.py --scale=10 --out=bench_new.json --compare=bench.json
+
+  Parsing a YAML lookup with PyYAML takes seconds even at scale 1, so it is left out unless asked for,
+    and then only compiled once.
+"""
+
+BENCHMARK_VERSION = 2
+
+GSML_HEADER = ['TEXT_ID', 'SENTENCE_ID', 'ANNOTATION_ID', 'TOKENS', 'SENT_TOKEN_START', 'SENT_TOKEN_END',
+               'DOC_TOKEN_START', 'DOC_TOKEN_END', 'TYPE', 'CORRECTION', 'COMMENT']
+
+''' Returns the lines of each text's entry in each section of a token lookup YAML file, as {section: {text_id: lines}} '''
+def token_lookup_fragments(yaml_filename):
+  fragments = {}
+  section = None
+  lines = None
+  with open(yaml_filename, 'r') as fh:
+    for line in fh:
+      if not line.startswith(' '):
+        section = fragments.setdefault(line.rstrip().rstrip(':'), {})
+      elif not line.startswith('   '):
+        lines = section.setdefault(line.strip().rstrip(':'), [])
+      else:
+        lines.append(line)
+  return fragments
+
+''' Returns (start, end) for a span of up to length tokens from start, which ends in the same sentence '''
+def sentence_span(index, text_id, start, length):
+  sentence_id, _ = index.doc_to_sent(text_id, start)
+  end = start
+  while end - start + 1 < length and end < index.num_tokens(text_id) and index.doc_to_sent(text_id, end+1)[0] == sentence_id:
+    end += 1
+  return start, end
+
+''' Marks a span as used, returns False (and marks nothing) if any of its tokens are already used '''
+def claim_span(used, start, end):
+  if any(used[start:end+1]):
+    return False
+  used[start:end+1] = b'\x01' * (end - start + 1)
+  return True
+
+''' Returns up to num_spans random spans from a text, which do not overlap each other or the used tokens '''
+def random_spans(rng, index, text_id, num_spans, span_length, used):
+  spans = []
+  for _ in range(num_spans * 20):
+    if len(spans) == num_spans:
+      break
+    start = rng.randint(1, index.num_tokens(text_id))
+    start, end = sentence_span(index, text_id, start, rng.randint(1, 2*span_length-1))
+    if claim_span(used, start, end):
+      spans.append((start, end))
+  return spans
+
+''' Returns a span which overlaps the GSML span (start, end) and none of the used tokens, or None '''
+def overlapping_span(rng, index, text_id, start, end, span_length, used):
+  for _ in range(20):
+    length = rng.randint(1, 2*span_length-1)
+    candidate = max(1, rng.randint(start - length + 1, end))
+    candidate, candidate_end = sentence_span(index, text_id, candidate, length)
+    if candidate <= end and candidate_end >= start and claim_span(used, candidate, candidate_end):
+      return candidate, candidate_end
+  return None
+
+'''
+  Writes a synthetic corpus (gsml.csv, submission.csv, texts/ and with yaml token_lookup.yaml) to corpus_dir.
+  Returns a dict describing it.
+'''
+def generate_corpus(corpus_dir, token_lookup_filename, text_dir, scale=10, spans_per_text=20, span_length=2, overlap=0.5, seed=0, yaml=False):
+  rng = random.Random(seed)
+  index = token_index.load_index(token_lookup_filename)
+  texts = text_store.get_text_store(text_dir)
+  categories = sorted(evaluate.all_categories())
+  base_text_ids = sorted(t for t in index.text_ids() if t in texts)
+
+  os.makedirs(os.path.join(corpus_dir, 'texts'), exist_ok=True)
+  text_ids = []
+  gsml_rows = []
+  submitted_rows = []
+  for copy in range(scale):
+    for base_text_id in base_text_ids:
+      text_id = f'{base_text_id}_{copy:04d}'
+      text_ids.append(text_id)
+      shutil.copyfile(texts.filename(base_text_id), os.path.join(corpus_dir, 'texts', f'{text_id}.txt'))
+
+      gsml_used = bytearray(index.num_tokens(base_text_id) + 2)
+      gsml_spans = random_spans(rng, index, base_text_id, spans_per_text, span_length, gsml_used)
+      gsml_spans.sort()
+      gsml_categories = []
+      for start, end in gsml_spans:
+        category = rng.choice(categories)
+        gsml_categories.append(category)
+        sentence_id, sent_start_idx = index.doc_to_sent(base_text_id, start)
+        sent_end_idx = index.doc_to_sent(base_text_id, end)[1]
+        gsml_rows.append([
+          f'{text_id}.txt', sentence_id, len(gsml_rows) + 1, texts.span(base_text_id, start, end),
+          sent_start_idx, sent_end_idx, start, end, category, '', '',
+        ])
+
+      # Submitted spans may overlap GSML spans, but not each other
+      submitted_used = bytearray(len(gsml_used))
+      submitted_spans = []
+      for (start, end), category in zip(gsml_spans, gsml_categories):
+        if rng.random() < overlap:
+          span = overlapping_span(rng, index, base_text_id, start, end, span_length, submitted_used)
+          if span != None:
+            submitted_spans.append((span, category if rng.random() < 0.7 else rng.choice(categories)))
+      unused = bytes(a | b for a, b in zip(gsml_used, submitted_used))
+      for span in random_spans(rng, index, base_text_id, len(gsml_spans) - len(submitted_spans), span_length, bytearray(unused)):
+        if claim_span(submitted_used, *span):
+          submitted_spans.append((span, rng.choice(categories)))
+      submitted_spans.sort()
+      for i, ((start, end), category) in enumerate(submitted_spans):
+        submitted_rows.append([f'{text_id}.txt', '', i + 1, texts.span(base_text_id, start, end), '', '', start, end, category, '', ''])
+
+  if yaml:
+    fragments = token_lookup_fragments(token_lookup_filename)
+    with open(os.path.join(corpus_dir, 'token_lookup.yaml'), 'w') as fh:
+      for section, texts_fragments in fragments.items():
+        fh.write(f'{section}:\n')
+        for text_id in text_ids:
+          fh.write(f'  {text_id}:\n')
+          fh.writelines(texts_fragments[text_id.rsplit("_", 1)[0]])
+
+  for filename, rows in [('gsml.csv', gsml_rows), ('submission.csv', submitted_rows)]:
+    with open(os.path.join(corpus_dir, filename), 'w', newline='') as fh:
+      writer = csv.writer(fh)
+      writer.writerow(GSML_HEADER)
+      writer.writerows(rows)
+
+  return {
+    'scale': scale,
+    'spans_per_text': spans_per_text,
+    'span_length': span_length,
+    'overlap': overlap,
+    'seed': seed,
+    'yaml': yaml,
+    'num_texts': len(text_ids),
+    'num_tokens': sum(index.num_tokens(t.rsplit('_', 1)[0]) for t in text_ids),
+    'gsml_rows': len(gsml_rows),
+    'submitted_rows': len(submitted_rows),
+  }
+
+''' Calls fn repeat times, returns (its last value, timings in seconds) '''
+def time_stage(fn, repeat):
+  times = []
+  value = None
+  for _ in range(repeat):
+    start = time.perf_counter()
+    value = fn()
+    times.append(time.perf_counter() - start)
+  return value, {'min': min(times), 'median': statistics.median(times), 'runs': times}
+
+''' Converts the span of every mistake to sentence token ids and back, as parsing does for rows with only one of them '''
+def convert_token_ids(index, mistake_dict):
+  for text_id, text_data in mistake_dict.items():
+    for mistake in text_data.values():
+      sentence_id, sent_start_idx = index.doc_to_sent(text_id, mistake.doc_start_idx)
+      sent_end_idx = index.doc_to_sent(text_id, mistake.doc_end_idx)[1]
+      index.sent_to_doc(text_id, sentence_id, sent_start_idx)
+      index.sent_to_doc(text_id, sentence_id, sent_end_idx)
+
+'''
+  Times each stage of the pipeline on a corpus written by generate_corpus(), returns {stage: timings}.
+  The token lookup is derived from the texts (reading them from disk on every run), the mistake lists
+    are read as evaluate.py reads them (validated, then parsed), and the lookup, matching and scoring
+    are timed separately.  When the corpus has a token_lookup.yaml, compiling it is timed once and
+    loading the compiled index on every run.
+  check_token_ids reads the raw texts from disk on every run (rather than from this process's TextStore).
+'''
+def run_stages(corpus_dir, repeat=3, cli=True):
+  yaml_filename = os.path.join(corpus_dir, 'token_lookup.yaml')
+  gsml_filename = os.path.join(corpus_dir, 'gsml.csv')
+  submitted_filename = os.path.join(corpus_dir, 'submission.csv')
+  text_dir = os.path.join(corpus_dir, 'texts')
+  text_ids = text_store.TextStore(text_dir).text_ids()
+  categories = set(evaluate.all_categories())
+  stages = {}
+
+  index, stages['token_lookup_from_texts'] = time_stage(
+    lambda: token_index.index_from_texts(text_store.TextStore(text_dir), text_ids), repeat)
+  if os.path.exists(yaml_filename):
+    _, stages['token_lookup_compile'] = time_stage(lambda: token_index.build_index(yaml_filename), 1)
+    _, stages['token_lookup_load'] = time_stage(lambda: token_index.load_index(yaml_filename), repeat)
+  gsml, stages['read_gsml'] = time_stage(
+    lambda: evaluate.read_mistake_list(gsml_filename, index, None, categories), repeat)
+  submitted, stages['read_submitted'] = time_stage(
+    lambda: evaluate.read_mistake_list(submitted_filename, index, None, categories), repeat)
+  _, stages['token_lookup_convert'] = time_stage(lambda: convert_token_ids(index, submitted), repeat)
+  _, stages['check_token_ids'] = time_stage(
+    lambda: evaluate.check_raw_tokens(submitted, text_store.TextStore(text_dir).preload(submitted.keys())), repeat)
+  _, stages['match_mistake_dicts'] = time_stage(lambda: evaluate.match_mistake_dicts(gsml, submitted), repeat)
+  _, stages['get_token_level_results'] = time_stage(
+    lambda: evaluate.get_token_level_results(gsml, submitted, index, evaluate.default_categories_list()), repeat)
+
+  if cli:
+    command = [
+      sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'evaluate.py'),
+      f'--gsml={gsml_filename}', f'--submitted={submitted_filename}', f'--text_dir={text_dir}',
+    ]
+    if os.path.exists(yaml_filename):
+      command.append(f'--token_lookup={yaml_filename}')
+    _, stages['cli'] = time_stage(lambda: subprocess.run(command, stdout=subprocess.DEVNULL, check=True), repeat)
+  return stages
+
+''' Returns the current git commit, or None outside a checkout '''
+def git_commit():
+  try:
+    return subprocess.run(
+      ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+      cwd=os.path.dirname(os.path.abspath(__file__))
+    ).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+'''
+  Prints the ratio of each stage's min time to the baseline's, returns the stages slower than tolerance times the baseline
+'''
+def compare(results, baseline, tolerance):
+  if results['corpus'] != baseline['corpus']:
+    print('Warning: the baseline was run on a different corpus')
+  regressions = []
+  for stage, timings in results['stages'].items():
+    if stage not in baseline['stages']:
+      continue
+    ratio = evaluate.safe_divide(timings['min'], baseline['stages'][stage]['min'])
+    if ratio is None:
+      # A baseline too fast to time cannot be compared with
+      print(f'{stage:32} {baseline["stages"][stage]["min"]:10.4f}s {timings["min"]:10.4f}s    n/a')
+      continue
+    print(f'{stage:32} {baseline["stages"][stage]["min"]:10.4f}s {timings["min"]:10.4f}s {ratio:6.2f}x')
+    if ratio > tolerance:
+      regressions.append(stage)
+  return regressions
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark the scoring pipeline on a synthetic corpus')
+  parser.add_argument('--scale', type=int, default=10,
+                      help='Number of copies of each base text, i.e. the size of the corpus relative to gsml.csv (default 10)')
+  parser.add_argument('--spans_per_text', type=int, default=20,
+                      help='Number of GSML (and submitted) mistakes in each text (default 20, about as in gsml.csv)')
+  parser.add_argument('--span_length', type=int, default=2,
+                      help='Mean length of a mistake in tokens (default 2)')
+  parser.add_argument('--overlap', type=float, default=0.5,
+                      help='Fraction of submitted mistakes which overlap a GSML mistake (default 0.5)')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--yaml', action='store_true',
+                      help='Also write a token_lookup.yaml for the corpus, and time compiling it (once) and loading the index (slow beyond a small scale)')
+  parser.add_argument('--token_lookup', type=str, default='token_lookup.yaml',
+                      help='The token lookup of the base texts')
+  parser.add_argument('--text_dir', type=str, default='texts',
+                      help='The directory of the base texts')
+  parser.add_argument('--corpus_dir', type=str,
+                      help='Where to write the synthetic corpus (kept), by default a temporary directory')
+  parser.add_argument('--generate_only', action='store_true',
+                      help='Write the corpus to --corpus_dir without timing anything')
+  parser.add_argument('--repeat', type=int, default=3,
+                      help='Number of times each stage is run (default 3)')
+  parser.add_argument('--no_cli', action='store_true',
+                      help='Do not time the full evaluate.py command')
+  parser.add_argument('--out', type=str,
+                      help='Path of the JSON results (printed when not given)')
+  parser.add_argument('--compare', type=str,
+                      help='JSON results of an earlier run, exits with status 1 if any stage is slower than --tolerance times it')
+  parser.add_argument('--tolerance', type=float, default=1.25)
+  args = parser.parse_args()
+
+  if args.generate_only and not args.corpus_dir:
+    raise Exception('--generate_only needs a --corpus_dir')
+  corpus_dir = args.corpus_dir or tempfile.mkdtemp(prefix='benchmark_')
+  try:
+    corpus = generate_corpus(
+      corpus_dir, args.token_lookup, args.text_dir, args.scale, args.spans_per_text, args.span_length, args.overlap, args.seed, args.yaml
+    )
+    if args.generate_only:
+      print(json.dumps(corpus, indent=2))
+      return
+    stages = run_stages(corpus_dir, args.repeat, not args.no_cli)
+  finally:
+    if not args.corpus_dir:
+      shutil.rmtree(corpus_dir, ignore_errors=True)
+
+  results = {
+    'benchmark_version': BENCHMARK_VERSION,
+    'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    'git_commit': git_commit(),
+    'python': platform.python_version(),
+    'platform': platform.platform(),
+    'corpus': corpus,
+    'repeat': args.repeat,
+    'stages': stages,
+  }
+  if args.out:
+    with open(args.out, 'w') as fh:
+      json.dump(results, fh, indent=2)
+  else:
+    print(json.dumps(results, indent=2))
+
+  if args.compare:
+    with open(args.compare, 'r') as fh:
+      baseline = json.load(fh)
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+      print(f'Slower than {args.tolerance}x the baseline: {", ".join(regressions)}')
+      sys.exit(1)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,170 @@
+import random
+
+"""
+  Text-level bootstrap confidence intervals for the results of evaluate.py
+
+  With only ~60 texts, the differences between systems are noisy.  The counts behind the results (see
+    evaluate.get_counts()) are computed once per text, then the texts are resampled with replacement
+    and the results recomputed from the summed counts of each resample.
+
+  Every count of a text is packed into one Python int (each in its own fixed width field), so summing
+    the counts of a resample is one big-int addition per sampled text, for all the counts at once.
+    The fields are wide enough that they can never carry into each other, so 10,000 resamples of the
+    shared task take well under a second without any numerical libraries.
+"""
+
+''' The counts of one list of categories which the results are computed from, in the order packed '''
+COUNT_FIELDS = [
+  'correct_recall',
+  'gsml_num_lines',
+  'submitted_num_lines',
+  'token_correct',
+  'token_recall_denominator',
+  'token_precision_denominator',
+]
+
+''' Each result, as (numerator, denominator) positions in COUNT_FIELDS '''
+METRICS = {
+  'recall': (0, 1),
+  'precision': (0, 2),
+  'token_recall': (3, 4),
+  'token_precision': (3, 5),
+}
+
+''' Returns the COUNT_FIELDS of a set of counts (from evaluate.get_counts()) '''
+def count_vector(counts):
+  return [
+    sum(counts['correct_recall'].values()),
+    counts['gsml_num_lines'],
+    counts['submitted_num_lines'],
+    counts['token']['recall'],
+    counts['token']['recall_denominator'],
+    counts['token']['precision_denominator'],
+  ]
+
+def ratio(x, y):
+  if y > 0:
+    return x / y
+  return None
+
+'''
+  Returns the count matrix: for each text, the count vectors of every list of categories in one row
+  A text which is not in per_text_counts (e.g. no mistakes in one of two paired submissions) has a row of zeros.
+'''
+def count_matrix(per_text_counts, text_ids, num_lists):
+  rows = []
+  for text_id in text_ids:
+    row = []
+    for counts in per_text_counts.get(text_id, []):
+      row.extend(count_vector(counts))
+    rows.append(row or [0] * (num_lists * len(COUNT_FIELDS)))
+  return rows
+
+''' Returns the number of lists of categories in per text counts '''
+def num_lists(per_text_counts):
+  for counts_list in per_text_counts.values():
+    return len(counts_list)
+  return 0
+
+"""
+  Returns a list of the column sums of the count matrix for each of the resamples
+  Each resample draws len(matrix) rows (texts) with replacement.
+"""
+def resample_sums(matrix, replicates, seed=None):
+  num_rows = len(matrix)
+  num_columns = len(matrix[0]) if matrix else 0
+  if num_rows == 0:
+    return [[0] * num_columns for _ in range(replicates)]
+
+  # A sum of num_rows values can be at most num_rows times the largest value
+  width = (max(max(row) for row in matrix) * num_rows).bit_length() + 1
+  packed = [sum(x << (k * width) for k, x in enumerate(row)) for row in matrix]
+  mask = (1 << width) - 1
+  shifts = [k * width for k in range(num_columns)]
+
+  rng = random.Random(seed)
+  sums = []
+  for _ in range(replicates):
+    total = sum(rng.choices(packed, k=num_rows))
+    sums.append([(total >> shift) & mask for shift in shifts])
+  return sums
+
+''' Returns the value of each metric, for the list of categories whose counts start at offset '''
+def metric_values(column_sums, offset=0):
+  return {
+    name: ratio(column_sums[offset + numerator], column_sums[offset + denominator])
+    for name, (numerator, denominator) in METRICS.items()
+  }
+
+''' Returns the (lower, upper) percentile interval of values (Nones are left out) '''
+def percentile_interval(values, confidence):
+  values = sorted(x for x in values if x != None)
+  if not values:
+    return None, None
+  alpha = (1 - confidence) / 2
+  last = len(values) - 1
+  return values[int(round(alpha * last))], values[int(round((1 - alpha) * last))]
+
+"""
+  Returns bootstrap confidence intervals for each list of categories, in the order of the results
+  per_text_counts maps TEXT_ID to the list of counts for that text (see Evaluator.count_per_text()).
+  Each entry is {metric: {'value', 'lower', 'upper'}} for recall, precision, token_recall and token_precision.
+"""
+def bootstrap_results(per_text_counts, replicates=10000, confidence=0.95, seed=None):
+  text_ids = sorted(per_text_counts.keys())
+  matrix = count_matrix(per_text_counts, text_ids, num_lists(per_text_counts))
+  totals = [sum(column) for column in zip(*matrix)]
+  sums = resample_sums(matrix, replicates, seed)
+
+  results = []
+  for offset in range(0, len(totals), len(COUNT_FIELDS)):
+    replicate_values = [metric_values(s, offset) for s in sums]
+    result = {}
+    for name, value in metric_values(totals, offset).items():
+      lower, upper = percentile_interval([v[name] for v in replicate_values], confidence)
+      result[name] = {'value': value, 'lower': lower, 'upper': upper}
+    results.append(result)
+  return results
+
+"""
+  Paired bootstrap of two submissions scored against the same GSML: the same texts are resampled for both
+  Returns, for each list of categories, {metric: {'difference', 'lower', 'upper', 'p_value'}} where the
+    difference is other minus baseline and p_value is the two sided bootstrap p-value of it being zero.
+"""
+def paired_bootstrap(baseline_per_text_counts, other_per_text_counts, replicates=10000, confidence=0.95, seed=None):
+  text_ids = sorted(set(baseline_per_text_counts) | set(other_per_text_counts))
+  lists = max(num_lists(baseline_per_text_counts), num_lists(other_per_text_counts))
+  num_columns = lists * len(COUNT_FIELDS)
+  baseline_matrix = count_matrix(baseline_per_text_counts, text_ids, lists)
+  other_matrix = count_matrix(other_per_text_counts, text_ids, lists)
+  matrix = [a + b for a, b in zip(baseline_matrix, other_matrix)]
+  totals = [sum(column) for column in zip(*matrix)]
+  sums = resample_sums(matrix, replicates, seed)
+
+  results = []
+  for offset in range(0, num_columns, len(COUNT_FIELDS)):
+    baseline_value = metric_values(totals, offset)
+    other_value = metric_values(totals, num_columns + offset)
+    differences = {name: [] for name in METRICS}
+    for s in sums:
+      a = metric_values(s, offset)
+      b = metric_values(s, num_columns + offset)
+      for name in METRICS:
+        if a[name] != None and b[name] != None:
+          differences[name].append(b[name] - a[name])
+
+    result = {}
+    for name in METRICS:
+      lower, upper = percentile_interval(differences[name], confidence)
+      values = differences[name]
+      p_value = None
+      if values:
+        below = sum(1 for x in values if x <= 0) / len(values)
+        above = sum(1 for x in values if x >= 0) / len(values)
+        p_value = min(1.0, 2 * min(below, above))
+      difference = None
+      if baseline_value[name] != None and other_value[name] != None:
+        difference = other_value[name] - baseline_value[name]
+      result[name] = {'difference': difference, 'lower': lower, 'upper': upper, 'p_value': p_value}
+    results.append(result)
+  return results
@@ -0,0 +1,166 @@
+import array
+import json
+import re
+
+"""
+  Indexed access to the box scores in shared_task.jsonl (one Rotowire game record per line)
+
+  The file is scanned once for the byte offset of each shared_task_text_id, and a game is only parsed
+    the first time it is asked for.  Each parsed game is then held as a GameRecord:
+  - one typed array per numeric box score stat (PTS, REB, AST, ...), indexed by player row
+  - an index from player name (full, first and second names) to player rows
+  - the home_line / vis_line of each team, indexed by team name, city and "city name"
+  so questions like "did Luol Deng score 3 points in S001" are dict and array lookups:
+
+    store = BoxScoreStore('shared_task.jsonl')
+    store['S001'].player_stat('Luol Deng', 'PTS') == 3
+"""
+
+''' Value stored in the stat arrays for players without a value (N/A in the JSON, e.g. did not play) '''
+MISSING = -1
+
+''' box_score columns which hold names rather than numbers '''
+TEXT_COLUMNS = {'FIRST_NAME', 'SECOND_NAME', 'PLAYER_NAME', 'START_POSITION', 'TEAM_CITY'}
+
+''' home_line / vis_line fields which hold names rather than numbers '''
+TEXT_LINE_FIELDS = {'TEAM-CITY', 'TEAM-NAME'}
+
+TEXT_ID_PATTERN = re.compile(rb'"shared_task_text_id":\s*"([^"]+)"')
+
+''' Returns an int for a numeric JSON value, or MISSING '''
+def stat_int(x):
+  try:
+    return int(x)
+  except (TypeError, ValueError):
+    return MISSING
+
+''' Returns a team line with its numeric fields as ints (or None when missing) '''
+def typed_line(line):
+  typed = {}
+  for k, v in line.items():
+    if k in TEXT_LINE_FIELDS:
+      typed[k] = v
+    else:
+      x = stat_int(v)
+      typed[k] = None if x == MISSING else x
+  return typed
+
+'''
+  One game from shared_task.jsonl, built from its JSON dict.
+  Player rows are the (int) keys of the box_score columns.
+'''
+class GameRecord:
+  def __init__(self, game):
+    self.text_id = game['shared_task_text_id']
+    self.day = game['day']
+    self.home_name = game['home_name']
+    self.vis_name = game['vis_name']
+    self.home_city = game['home_city']
+    self.vis_city = game['vis_city']
+
+    box_score = game['box_score']
+    self.num_rows = 1 + max(int(k) for column in box_score.values() for k in column.keys())
+
+    # Name columns as lists, numeric columns as typed arrays
+    self.names = {}
+    self.stats = {}
+    for column_name, column in box_score.items():
+      if column_name in TEXT_COLUMNS:
+        values = [None] * self.num_rows
+        for k, v in column.items():
+          values[int(k)] = v
+        self.names[column_name] = values
+      else:
+        values = array.array('i', [MISSING]) * self.num_rows
+        for k, v in column.items():
+          values[int(k)] = stat_int(v)
+        self.stats[column_name] = values
+
+    # Name => player rows (a first or second name can belong to more than one player)
+    self.player_index = {}
+    for column_name in ['PLAYER_NAME', 'FIRST_NAME', 'SECOND_NAME']:
+      for row, name in enumerate(self.names.get(column_name, [])):
+        if name is None:
+          continue
+        rows = self.player_index.setdefault(name, [])
+        if row not in rows:
+          rows.append(row)
+
+    # Team => line, cities are only indexed when the two teams are not from the same one
+    self.lines = {
+      'home': typed_line(game['home_line']),
+      'vis': typed_line(game['vis_line']),
+    }
+    self.team_index = {}
+    for side, line in self.lines.items():
+      name, city = line['TEAM-NAME'], line['TEAM-CITY']
+      self.team_index[name] = side
+      self.team_index[f'{city} {name}'] = side
+    if self.home_city != self.vis_city:
+      self.team_index[self.lines['home']['TEAM-CITY']] = 'home'
+      self.team_index[self.lines['vis']['TEAM-CITY']] = 'vis'
+
+  ''' Returns the player rows for a name (full, first or second), raises KeyError for unknown names '''
+  def player_rows(self, name):
+    return self.player_index[name]
+
+  ''' Returns the player row for a name, which must identify exactly one player '''
+  def player_row(self, name):
+    rows = self.player_rows(name)
+    if len(rows) != 1:
+      raise KeyError(f'{name} matches {len(rows)} players in {self.text_id}')
+    return rows[0]
+
+  ''' Returns a stat for the player at a row, or None if the player has no value for it '''
+  def stat(self, row, stat_name):
+    x = self.stats[stat_name][row]
+    return None if x == MISSING else x
+
+  ''' Returns a stat for the player with a name (see player_row()) '''
+  def player_stat(self, name, stat_name):
+    return self.stat(self.player_row(name), stat_name)
+
+  ''' Returns True if any player with the name has the value for the stat '''
+  def player_has(self, name, stat_name, value):
+    values = self.stats[stat_name]
+    return any(values[row] == value for row in self.player_index.get(name, []))
+
+  ''' Returns the line (home_line or vis_line) for a team name, city or "city name" '''
+  def team_line(self, team):
+    return self.lines[self.team_index[team]]
+
+'''
+  The games in a shared_task.jsonl file, keyed by shared_task_text_id and parsed on first access.
+'''
+class BoxScoreStore:
+  def __init__(self, filename):
+    self.filename = filename
+    self._offsets = {}
+    self._games = {}
+    with open(filename, 'rb') as fh:
+      offset = 0
+      for line in fh:
+        m = TEXT_ID_PATTERN.search(line)
+        if m:
+          self._offsets[m.group(1).decode('utf-8')] = offset
+        offset += len(line)
+
+  ''' Returns the text ids, in file order '''
+  def text_ids(self):
+    return list(self._offsets.keys())
+
+  def __contains__(self, text_id):
+    return text_id in self._offsets
+
+  def __getitem__(self, text_id):
+    game = self._games.get(text_id)
+    if game is None:
+      game = GameRecord(self.load_json(text_id))
+      self._games[text_id] = game
+    return game
+
+  ''' Returns the JSON dict for one game, as in the file '''
+  def load_json(self, text_id):
+    with open(self.filename, 'rb') as fh:
+      fh.seek(self._offsets[text_id])
+      return json.loads(fh.readline())
@@ -0,0 +1,158 @@
+import argparse
+import os
+
+import evaluate
+
+"""
+  Scores a submission against several corpora in one run, e.g. the training texts and test_set/
+
+  Each corpus (a GSML, a token lookup and a directory of raw texts) is registered under a name, and its
+    Evaluator is loaded the first time it is used, then kept in a registry shared by the whole process.
+  A submission's rows are routed to the corpus whose token lookup has their TEXT_ID (the corpora must
+    not share TEXT_IDs), every corpus is scored, and the counts of all of them are pooled:
+
+    python corpora.py --submitted=submission.csv
+    python corpora.py --corpus=train=gsml.csv,token_lookup.yaml,texts --corpus=test=test_set/gsml.csv,test_set/token_lookup.yaml,test_set/texts --submitted=submission.csv
+
+  Without --corpus, the training and test corpora in this repository are used.
+  The pooled results are computed from the summed counts, so they weigh every mistake equally rather
+    than averaging the corpora.
+"""
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+''' The name of the results of all the corpora together '''
+POOLED = 'pooled'
+
+''' One corpus: where its GSML, token lookup and raw texts are '''
+class Corpus:
+  def __init__(self, name, gsml, token_lookup, text_dir=None):
+    self.name = name
+    self.gsml = gsml
+    self.token_lookup = token_lookup
+    self.text_dir = text_dir
+
+  def __repr__(self):
+    return f'Corpus({self.name} {self.gsml} {self.token_lookup} {self.text_dir})'
+
+''' Returns the corpora shipped in this repository: the training texts and test_set/ '''
+def default_corpora():
+  return [
+    Corpus('train', os.path.join(REPO_DIR, 'gsml.csv'), os.path.join(REPO_DIR, 'token_lookup.yaml'), os.path.join(REPO_DIR, 'texts')),
+    Corpus('test', *[os.path.join(REPO_DIR, 'test_set', f) for f in ['gsml.csv', 'token_lookup.yaml', 'texts']]),
+  ]
+
+''' Returns a Corpus for a --corpus argument, NAME=GSML,TOKEN_LOOKUP[,TEXT_DIR] '''
+def parse_corpus(arg):
+  name, sep, paths = arg.partition('=')
+  paths = paths.split(',')
+  if not sep or not name or len(paths) not in [2, 3]:
+    raise Exception(f'A corpus is given as NAME=GSML,TOKEN_LOOKUP[,TEXT_DIR], not {arg}')
+  return Corpus(name, *paths)
+
+_evaluators = {}
+
+"""
+  Returns the Evaluator for a corpus, shared by everything in this process
+  It is loaded once for each corpus (by the absolute paths of its files) and list of categories.
+"""
+def get_evaluator(corpus, categories_list=None):
+  categories_list = categories_list or evaluate.default_categories_list()
+  key = (
+    os.path.abspath(corpus.gsml),
+    os.path.abspath(corpus.token_lookup),
+    corpus.text_dir and os.path.abspath(corpus.text_dir),
+    tuple(tuple(categories) for categories in categories_list),
+  )
+  if key not in _evaluators:
+    _evaluators[key] = evaluate.Evaluator(corpus.gsml, corpus.token_lookup, corpus.text_dir, categories_list)
+  return _evaluators[key]
+
+"""
+  The corpora a submission is scored against, in the order they were registered
+  Results are {corpus name: list of result dicts}, for each corpus and for POOLED, with one result dict
+    for each list of categories (see evaluate.calculate_recall_and_precision()).
+"""
+class CorpusRegistry:
+  def __init__(self, corpora=None, categories_list=None):
+    self.categories_list = categories_list or evaluate.default_categories_list()
+    self.corpora = {}
+    for corpus in corpora or []:
+      self.register(corpus)
+
+  def register(self, corpus):
+    if corpus.name in self.corpora or corpus.name == POOLED:
+      raise Exception(f'There is already a corpus named {corpus.name}')
+    self.corpora[corpus.name] = corpus
+
+  def evaluator(self, name):
+    return get_evaluator(self.corpora[name], self.categories_list)
+
+  ''' Returns the name of the corpus whose token lookup has each TEXT_ID, raising if one has several '''
+  def text_corpora(self):
+    text_corpora = {}
+    for name in self.corpora:
+      for text_id in self.evaluator(name).token_lookup.text_ids():
+        if text_id in text_corpora:
+          raise Exception(f'{text_id} is in both the {text_corpora[text_id]} and {name} corpora')
+        text_corpora[text_id] = name
+    return text_corpora
+
+  """
+    Returns {corpus name: [(row number, row), ...]} for a submission CSV, every corpus has an entry
+    Raises if a row's TEXT_ID is in none of the corpora.
+  """
+  def route_rows(self, submitted_filename):
+    text_corpora = self.text_corpora()
+    routed = {name: [] for name in self.corpora}
+    for i, row in evaluate.iterate_numbered_rows(submitted_filename):
+      text_id = row[0].replace('.txt', '')
+      if text_id not in text_corpora:
+        raise Exception(f'{text_id} (row {i} of {submitted_filename}) is not in any of the corpora {list(self.corpora)}')
+      routed[text_corpora[text_id]].append((i, row))
+    return routed
+
+  ''' Returns {corpus name: list of counts (see evaluate.get_counts())} for a submission CSV, including POOLED '''
+  def count_file(self, submitted_filename):
+    counts = {}
+    for name, numbered_rows in self.route_rows(submitted_filename).items():
+      counts[name] = self.evaluator(name).count_numbered_rows(numbered_rows, submitted_filename, self.categories_list)
+    counts[POOLED] = evaluate.merge_counts_lists(list(counts.values()))
+    return counts
+
+  ''' Returns {corpus name: list of result dicts} for a submission CSV, including POOLED '''
+  def score_file(self, submitted_filename):
+    return {
+      name: [evaluate.get_result(c) for c in counts_list]
+      for name, counts_list in self.count_file(submitted_filename).items()
+    }
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Score submissions against several corpora in one run, per corpus and pooled')
+  parser.add_argument('--corpus', type=str, action='append',
+                      help='A corpus as NAME=GSML,TOKEN_LOOKUP[,TEXT_DIR], can be given more than once (default: the training and test corpora)')
+  parser.add_argument('--submitted', type=str,
+                      help='The submitted file path (CSV), or a directory or glob pattern of submissions to score in one run')
+  parser.add_argument('--csv_out', type=str,
+                      help='Path to an output CSV file for stats (optional), with rows for every submission and corpus')
+  args = parser.parse_args()
+
+  corpora = [parse_corpus(x) for x in args.corpus] if args.corpus else default_corpora()
+  registry = CorpusRegistry(corpora)
+  csv_lines = [['corpus', 'categories', 'recall', 'precision', 'token_recall', 'token_precision', 'submitted_filename']]
+
+  for submitted_filename in evaluate.expand_submitted_filenames(args.submitted):
+    print(f'comparing {", ".join(registry.corpora)} to submission => "{submitted_filename}"')
+    for name, results in registry.score_file(submitted_filename).items():
+      print(f'\n-- {name}')
+      for categories, result in zip(registry.categories_list, results):
+        values = [evaluate.format_result_value(result[k]['value']) for k in ['recall', 'precision', 'token_recall', 'token_precision']]
+        print(f'\t[{", ".join(categories)}] recall => {values[0]}, precision => {values[1]}, token_recall => {values[2]}, token_precision => {values[3]}')
+        csv_lines.append([name, '|'.join(categories)] + [str(x) for x in values] + [submitted_filename])
+    print('\n')
+
+  if args.csv_out != None:
+    with open(args.csv_out, 'w') as fh:
+      s = '\n'.join([','.join(arr) for arr in csv_lines])
+      fh.write(f'{s}\n')
@@ -0,0 +1,236 @@
+import argparse
+import asyncio
+import concurrent.futures
+import csv
+import io
+import json
+import multiprocessing
+import os
+
+import evaluate
+
+"""
+  A long-running evaluation server, which loads the token lookup, the GSML and the raw texts once
+
+  Submissions are POSTed as CSV (in the format of gsml.csv, with the header) to /score, and the
+    response is the JSON list of results for every list of categories (all combined, then each one),
+    as in calculate_recall_and_precision():
+
+    python eval_server.py --gsml=gsml.csv --token_lookup=token_lookup.yaml --text_dir=texts --port=8765
+    curl --data-binary @example_submissions/submission.csv http://127.0.0.1:8765/score
+
+  Scoring runs in a pool of worker processes, so the event loop stays responsive.  At most `workers`
+    submissions are scored at once and at most max_pending wait for a worker; further requests are
+    turned away with 503 (and Retry-After) rather than queueing without bound, before their body is read.
+  A request's line and headers must arrive within HEADER_TIMEOUT seconds, in at most MAX_HEADER_LINES
+    lines of at most MAX_LINE_BYTES each.
+"""
+
+MAX_HEADER_LINES = 100
+MAX_LINE_BYTES = 64 * 1024
+HEADER_TIMEOUT = 10
+
+BUSY_ERROR = 'Too many submissions are waiting to be scored, try again later'
+
+STATUS_TEXT = {
+  200: 'OK',
+  400: 'Bad Request',
+  404: 'Not Found',
+  405: 'Method Not Allowed',
+  408: 'Request Timeout',
+  413: 'Payload Too Large',
+  500: 'Internal Server Error',
+  503: 'Service Unavailable',
+}
+
+''' The Evaluator of a worker process, inherited from the server when it forks the workers '''
+_evaluator = None
+
+''' Worker initializer: builds the Evaluator where it was not inherited (processes which are not forked) '''
+def _init_worker(gsml, token_lookup, text_dir):
+  global _evaluator
+  if _evaluator is None:
+    _evaluator = evaluate.Evaluator(gsml, token_lookup, text_dir)
+
+"""
+  Worker: scores a submission CSV, returns (HTTP status, JSON-encodable body)
+  Problems with the submission (not CSV, not the columns of the GSML, or invalid mistakes) are 400s,
+    anything else is a 500.
+"""
+def _score_csv(csv_text):
+  num_columns = len(evaluate.COLUMNS)
+  try:
+    reader = csv.reader(io.StringIO(csv_text), delimiter=',', quotechar='"')
+    header = next(reader, None)
+    if header is None or [c.strip().lstrip('\ufeff') for c in header[:num_columns]] != evaluate.COLUMNS:
+      return 400, {'error': f'The submission must start with the header of the GSML, {",".join(evaluate.COLUMNS)}'}
+    rows = list(reader)
+  except csv.Error as e:
+    return 400, {'error': f'The submission is not valid CSV: {e}'}
+  for i, row in enumerate(rows):
+    if len(row) < num_columns:
+      return 400, {'error': f'Row {i} of the submission has {len(row)} columns rather than {num_columns}'}
+
+  try:
+    results = _evaluator.score(rows)
+  except evaluate.InvalidMistakeList as e:
+    return 400, {'error': f'{type(e).__name__}: {e}'}
+  except Exception as e:
+    return 500, {'error': f'{type(e).__name__}: {e}'}
+  return 200, {
+    'results': [
+      {'categories': categories, **result}
+      for categories, result in zip(_evaluator.categories_list, results)
+    ]
+  }
+
+class EvaluationServer:
+  def __init__(self, evaluator, gsml, token_lookup, text_dir, workers=2, max_pending=None, max_body_bytes=64*1024*1024):
+    global _evaluator
+    self.gsml = gsml
+    self.workers = workers
+    self.max_pending = max_pending if max_pending != None else 4 * workers
+    self.max_body_bytes = max_body_bytes
+    self.pending = 0
+    self.scored = 0
+    self._slots = None
+
+    _evaluator = evaluator
+    mp_context = None
+    if 'fork' in multiprocessing.get_all_start_methods():
+      mp_context = multiprocessing.get_context('fork')
+    self.pool = concurrent.futures.ProcessPoolExecutor(
+      workers, mp_context=mp_context, initializer=_init_worker, initargs=(gsml, token_lookup, text_dir)
+    )
+
+  ''' Returns True when no more submissions can wait for a worker '''
+  def busy(self):
+    return self.pending >= self.workers + self.max_pending
+
+  ''' Scores a submission CSV in the pool, returns (HTTP status, body) '''
+  async def score(self, csv_text):
+    if self.busy():
+      return 503, {'error': BUSY_ERROR}
+    self.pending += 1
+    try:
+      async with self._slots:
+        loop = asyncio.get_running_loop()
+        status, body = await loop.run_in_executor(self.pool, _score_csv, csv_text)
+        self.scored += 1
+        return status, body
+    finally:
+      self.pending -= 1
+
+  async def route(self, method, path, body):
+    path = path.split('?', 1)[0]
+    if path == '/health':
+      return 200, {'status': 'ok', 'gsml': str(self.gsml), 'pending': self.pending, 'scored': self.scored}
+    if path == '/score':
+      if method != 'POST':
+        return 405, {'error': 'POST a submission CSV to /score'}
+      try:
+        csv_text = body.decode('utf-8')
+      except UnicodeDecodeError:
+        return 400, {'error': 'The submission must be UTF-8'}
+      return await self.score(csv_text)
+    return 404, {'error': f'Unknown path {path}'}
+
+  ''' Handles one HTTP/1.1 request per connection '''
+  async def handle(self, reader, writer):
+    try:
+      status, body = await self.handle_request(reader)
+    except (asyncio.IncompleteReadError, ValueError):
+      status, body = 400, {'error': 'Malformed request'}
+    except asyncio.TimeoutError:
+      status, body = 408, {'error': f'The request headers must be sent within {HEADER_TIMEOUT} seconds'}
+    except Exception as e:
+      # e.g. a worker process which died
+      status, body = 500, {'error': f'{type(e).__name__}: {e}'}
+    payload = json.dumps(body).encode('utf-8')
+    headers = [
+      f'HTTP/1.1 {status} {STATUS_TEXT[status]}',
+      'Content-Type: application/json',
+      f'Content-Length: {len(payload)}',
+      'Connection: close',
+    ]
+    if status == 503:
+      headers.append('Retry-After: 1')
+    try:
+      writer.write(('\r\n'.join(headers) + '\r\n\r\n').encode('latin-1') + payload)
+      await writer.drain()
+    except ConnectionError:
+      pass
+    finally:
+      writer.close()
+
+  """
+    Reads the request line and headers, returns (method, path, content length)
+    Raises ValueError when there are more than MAX_HEADER_LINES headers (or a line is longer than the
+      reader's limit).
+  """
+  async def read_head(self, reader):
+    request_line = (await reader.readline()).decode('latin-1').strip()
+    method, path, _ = request_line.split(' ', 2)
+    content_length = 0
+    for _ in range(MAX_HEADER_LINES):
+      line = (await reader.readline()).decode('latin-1').strip()
+      if not line:
+        return method, path, content_length
+      name, _, value = line.partition(':')
+      if name.strip().lower() == 'content-length':
+        content_length = int(value.strip())
+    raise ValueError(f'More than {MAX_HEADER_LINES} header lines')
+
+  async def handle_request(self, reader):
+    method, path, content_length = await asyncio.wait_for(self.read_head(reader), HEADER_TIMEOUT)
+    if content_length > self.max_body_bytes:
+      return 413, {'error': f'Submissions are limited to {self.max_body_bytes} bytes'}
+    # Turn a submission away before reading it when it could not be scored anyway
+    if method == 'POST' and path.split('?', 1)[0] == '/score' and self.busy():
+      return 503, {'error': BUSY_ERROR}
+    body = await reader.readexactly(content_length) if content_length else b''
+    return await self.route(method, path, body)
+
+  ''' Serves until cancelled, on a Unix socket when one is given, otherwise on host:port '''
+  async def serve(self, host='127.0.0.1', port=8765, unix_socket=None):
+    self._slots = asyncio.Semaphore(self.workers)
+    if unix_socket != None:
+      server = await asyncio.start_unix_server(self.handle, path=unix_socket, limit=MAX_LINE_BYTES)
+      print(f'Serving on {unix_socket}')
+    else:
+      server = await asyncio.start_server(self.handle, host, port, limit=MAX_LINE_BYTES)
+      print(f'Serving on http://{host}:{port}')
+    async with server:
+      await server.serve_forever()
+
+  def close(self):
+    self.pool.shutdown()
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Serve evaluate.py over HTTP, with the GSML and token lookup loaded once')
+  parser.add_argument('--gsml', type=str,
+                      help='The GSML file path (CSV)')
+  parser.add_argument('--token_lookup', type=str,
+                      help='The tokenization file (YAML), a compiled index is kept alongside it, or a directory of shards built with token_index.py --shards')
+  parser.add_argument('--text_dir', type=str,
+                      help='The directory where the raw texts are')
+  parser.add_argument('--host', type=str, default='127.0.0.1')
+  parser.add_argument('--port', type=int, default=8765)
+  parser.add_argument('--socket', type=str,
+                      help='Path of a Unix socket to serve on, instead of host and port')
+  parser.add_argument('--workers', type=int, default=max(1, (os.cpu_count() or 2) - 1),
+                      help='Number of processes to score with (default: one less than the number of CPUs)')
+  parser.add_argument('--max_pending', type=int,
+                      help='Number of submissions which can wait for a worker before requests are refused (default 4 per worker)')
+  args = parser.parse_args()
+
+  print('Loading the token lookup and GSML...')
+  evaluator = evaluate.Evaluator(args.gsml, args.token_lookup, args.text_dir)
+  server = EvaluationServer(evaluator, args.gsml, args.token_lookup, args.text_dir, args.workers, args.max_pending)
+  try:
+    asyncio.run(server.serve(args.host, args.port, args.socket))
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.close()
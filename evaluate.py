@@ -1,13 +1,21 @@
+import contextlib
 import csv
+import glob
+import heapq
 import json
+import match_export
+import multiprocessing
+import os
 import pprint
+import profiling
 import sys
-import yaml
-from copy import deepcopy
+import result_cache
+import tempfile
+import text_store
+import token_index
 import argparse
-
-# Instantiate the parser
-parser = argparse.ArgumentParser(description='Optional app description')
+import bootstrap
+from bisect import bisect_left
 
 # Create the pretty printer
 pp = pprint.PrettyPrinter(indent=4)
@@ -30,7 +38,48 @@ def all_categories():
 
 ''' Returns an int or None '''
 def csv_int(x):
-  return int(x) if x else None
+  return int(x) if x != '' else None
+
+''' The columns of a mistake list which are used for evaluation, in order (as in gsml.csv) '''
+COLUMNS = [
+  'TEXT_ID',
+  'SENTENCE_ID',
+  'ANNOTATION_ID',
+  'TOKENS',
+  'SENT_TOKEN_START',
+  'SENT_TOKEN_END',
+  'DOC_TOKEN_START',
+  'DOC_TOKEN_END',
+  'TYPE',
+]
+
+''' Returns a cell value as csv.reader would give it, missing values (None or NaN) become '' '''
+def cell_value(x):
+  if x is None or (isinstance(x, float) and x != x):
+    return ''
+  return x
+
+"""
+  Yields the rows of an in-memory mistake list in the form csv.reader gives them, for create_mistake_dict_from_rows()
+  The rows can be:
+  - tuples or lists, in the order of COLUMNS (any further columns are ignored)
+  - dicts keyed by the names in COLUMNS
+  - a DataFrame-like object with those columns (anything with columns and itertuples())
+  Numbers can be given as ints or strings.
+"""
+def iterate_rows(rows):
+  if hasattr(rows, 'itertuples'):
+    columns = list(rows.columns)
+    positions = [columns.index(c) for c in COLUMNS]
+    rows = ([t[k] for k in positions] for t in rows.itertuples(index=False, name=None))
+
+  for row in rows:
+    if isinstance(row, dict):
+      row = [row.get(c) for c in COLUMNS]
+    row = [cell_value(x) for x in row[:len(COLUMNS)]]
+    for k in [0, 3, 8]:
+      row[k] = str(row[k])
+    yield row
 
 ''' Helper that checks that either DOC or SENT based tokenization is used throughout'''
 def consistent_tokenization(tokenization_mode, current_line_mode):
@@ -38,134 +87,330 @@ def consistent_tokenization(tokenization_mode, current_line_mode):
     raise Exception('You must consistently use either document-based, sentence-based or both for the tokenization method.')
   return current_line_mode
 
+''' One mistake from a mistake list (GSML or Submission), the spans include both ends '''
+class Mistake:
+  __slots__ = (
+    'doc_start_idx',
+    'doc_end_idx',
+    'sentence_id',
+    'sent_start_idx',
+    'sent_end_idx',
+    'category',
+    'annotation_id',
+    'tokens',
+  )
+
+  def __init__(self, doc_start_idx, doc_end_idx, sentence_id, sent_start_idx, sent_end_idx, category, annotation_id, tokens):
+    self.doc_start_idx  = doc_start_idx
+    self.doc_end_idx    = doc_end_idx
+    self.sentence_id    = sentence_id
+    self.sent_start_idx = sent_start_idx
+    self.sent_end_idx   = sent_end_idx
+    self.category       = category
+    self.annotation_id  = annotation_id
+    self.tokens         = tokens
+
+  def __repr__(self):
+    return f'Mistake({self.category} {self.doc_start_idx}-{self.doc_end_idx} "{self.tokens}")'
+
+"""
+  Records a span as used, unless it overlaps a span already used.
+  spans_used is a tuple of the (sorted) starts and ends of the spans used so far in a text, as these
+    cannot overlap only the first span ending at or after start_idx needs to be checked.
+  Returns None, or the first token of the span which was already used.
+"""
+def use_span(spans_used, start_idx, end_idx):
+  starts, ends = spans_used
+  if end_idx < start_idx:
+    return None
+  pos = bisect_left(ends, start_idx)
+  if pos < len(starts) and starts[pos] <= end_idx:
+    return max(start_idx, starts[pos])
+  starts.insert(pos, start_idx)
+  ends.insert(pos, end_idx)
+  return None
+
 """
   Creates and returns a dictionary representation of the mistake list (GSML or Submission)
   The dictiory is structured as:
   - TEXT_ID, TEXT_DATA
     - START_IDX, MISTAKE_DATA
+  Each MISTAKE_DATA is a Mistake record.
   The function returns a tuple where the first element is the dict, and the second is num_mistakes
 """
 def create_mistake_dict(filename, categories, token_lookup):
-  mistake_dict = {}
-  tokens_used = {}
-  matches = 0
   with open(filename, newline='') as csvfile:
     reader = csv.reader(csvfile, delimiter=',', quotechar='"')
     next(reader, None)
+    return create_mistake_dict_from_rows(enumerate(reader), categories, token_lookup, filename)
 
-    num_mistakes = 0
-
-    tokenization_mode = None
-
-    for i, row in enumerate(reader):
-      # Columns from the CSV
-      text_id         = row[0].replace('.txt','')
-      sentence_id     = csv_int(row[1])
-      annotation_id   = csv_int(row[2])
-      tokens          = row[3]
-      sent_start_idx  = csv_int(row[4])
-      sent_end_idx    = csv_int(row[5])
-      doc_start_idx   = csv_int(row[6])
-      doc_end_idx     = csv_int(row[7])
-      category        = row[8]
-
-      # Check the sanity of the token submissions
-      sent_given = (sent_start_idx != None and sent_end_idx != None and sentence_id != None)
-      doc_given = (doc_start_idx != None and doc_end_idx != None)
-
-      if sent_given and doc_given:
-        tokenization_mode = consistent_tokenization(tokenization_mode, 'BOTH')
-        # Check mapping from sent to doc tokenization matches our token_lookup
-        assert doc_start_idx == token_lookup['sent_to_doc'][text_id][sentence_id][sent_start_idx]
-        assert doc_end_idx == token_lookup['sent_to_doc'][text_id][sentence_id][sent_end_idx]
-        # And doc to sent
-        assert sentence_id == token_lookup['doc_to_sent'][text_id][doc_start_idx]['sentence_id']
-        assert sent_start_idx == token_lookup['doc_to_sent'][text_id][doc_start_idx]['token_id']
-        assert sent_end_idx == token_lookup['doc_to_sent'][text_id][doc_end_idx]['token_id']
-      elif sent_given:
-        tokenization_mode = consistent_tokenization(tokenization_mode, 'SENT')
-        doc_start_idx = token_lookup['sent_to_doc'][text_id][sentence_id][sent_start_idx]
-        doc_end_idx   = token_lookup['sent_to_doc'][text_id][sentence_id][sent_end_idx]
-      elif doc_given:
-        tokenization_mode = consistent_tokenization(tokenization_mode, 'DOC')
-        sentence_id = token_lookup['doc_to_sent'][text_id][doc_start_idx]['sentence_id']
-        sent_start_idx = token_lookup['doc_to_sent'][text_id][doc_start_idx]['token_id']
-        sent_end_idx = token_lookup['doc_to_sent'][text_id][doc_end_idx]['token_id']
-      else:
-        err_str = f'You must provide either document or sentence based token ids on {filename} row {i}'
+"""
+  As create_mistake_dict(), but for rows already read (without the header), in the form csv.reader gives
+    (see iterate_rows() for other forms).
+  numbered_rows are (row number, row) pairs, the numbers are used in error messages along with source.
+  With validated, the rows have already passed a MistakeListValidator, so the consistency, lookup and
+    overlap checks are skipped and the lookup is only used to fill in the missing token ids.
+"""
+def create_mistake_dict_from_rows(numbered_rows, categories, token_lookup, source='rows', validated=False):
+  mistake_dict = {}
+  spans_used = {}
+  num_mistakes = 0
+
+  tokenization_mode = None
+
+  for i, row in numbered_rows:
+    # Columns from the CSV
+    text_id         = row[0].replace('.txt','')
+    sentence_id     = csv_int(row[1])
+    annotation_id   = csv_int(row[2])
+    tokens          = row[3]
+    sent_start_idx  = csv_int(row[4])
+    sent_end_idx    = csv_int(row[5])
+    doc_start_idx   = csv_int(row[6])
+    doc_end_idx     = csv_int(row[7])
+    category        = row[8]
+
+    # Check the sanity of the token submissions
+    sent_given = (sent_start_idx != None and sent_end_idx != None and sentence_id != None)
+    doc_given = (doc_start_idx != None and doc_end_idx != None)
+
+    if validated:
+      if not doc_given:
+        doc_start_idx = token_lookup.sent_to_doc(text_id, sentence_id, sent_start_idx)
+        doc_end_idx   = token_lookup.sent_to_doc(text_id, sentence_id, sent_end_idx)
+      elif not sent_given:
+        sentence_id, sent_start_idx = token_lookup.doc_to_sent(text_id, doc_start_idx)
+        sent_end_idx = token_lookup.doc_to_sent(text_id, doc_end_idx)[1]
+    elif sent_given and doc_given:
+      tokenization_mode = consistent_tokenization(tokenization_mode, 'BOTH')
+      # Check mapping from sent to doc tokenization matches our token_lookup
+      assert doc_start_idx == token_lookup.sent_to_doc(text_id, sentence_id, sent_start_idx)
+      assert doc_end_idx == token_lookup.sent_to_doc(text_id, sentence_id, sent_end_idx)
+      # And doc to sent
+      assert (sentence_id, sent_start_idx) == token_lookup.doc_to_sent(text_id, doc_start_idx)
+      assert sent_end_idx == token_lookup.doc_to_sent(text_id, doc_end_idx)[1]
+    elif sent_given:
+      tokenization_mode = consistent_tokenization(tokenization_mode, 'SENT')
+      doc_start_idx = token_lookup.sent_to_doc(text_id, sentence_id, sent_start_idx)
+      doc_end_idx   = token_lookup.sent_to_doc(text_id, sentence_id, sent_end_idx)
+    elif doc_given:
+      tokenization_mode = consistent_tokenization(tokenization_mode, 'DOC')
+      sentence_id, sent_start_idx = token_lookup.doc_to_sent(text_id, doc_start_idx)
+      sent_end_idx = token_lookup.doc_to_sent(text_id, doc_end_idx)[1]
+    else:
+      err_str = f'You must provide either document or sentence based token ids on {source} row {i}'
+      raise Exception(err_str)
+
+    if category not in categories:
+      continue
+
+    # For detecting overlapping spans
+    if not validated:
+      if text_id not in spans_used:
+        spans_used[text_id] = ([], [])
+
+      x = use_span(spans_used[text_id], doc_start_idx, doc_end_idx)
+      if x != None:
+        err_str = f'Token {x} already used, duplicate on {text_id}:{i}'
         raise Exception(err_str)
 
-      if category not in categories:
-        continue
+    # The mistake data structure
+    if text_id not in mistake_dict:
+      mistake_dict[text_id] = {}
 
-      # For detecting overlapping spans
-      if text_id not in tokens_used:
-        tokens_used[text_id] = set([])
-
-      for x in range(doc_start_idx, doc_end_idx+1):
-        if x in tokens_used[text_id]:
-          err_str = f'Token {x} already used, duplicate on {text_id}:{i}'
-          raise Exception(err_str)
-        tokens_used[text_id].add(x)
-
-      # The mistake data structure
-      if text_id not in mistake_dict:
-        mistake_dict[text_id] = {}
-
-      mistake_dict[text_id][doc_start_idx] = {
-        'set':            set(range(doc_start_idx, doc_end_idx+1)),
-        'category':       category,
-        'sent_start_idx': sent_start_idx,
-        'sent_end_idx':   sent_start_idx,
-        'doc_start_idx':  doc_start_idx,
-        'doc_end_idx':    doc_end_idx,
-        'sentence_id':    sentence_id,
-        'annotation_id':  annotation_id,
-        'tokens':         tokens,
-      }
-      num_mistakes += 1
+    mistake_dict[text_id][doc_start_idx] = Mistake(
+      doc_start_idx, doc_end_idx, sentence_id, sent_start_idx, sent_end_idx,
+      sys.intern(category), annotation_id, tokens
+    )
+    num_mistakes += 1
   return mistake_dict, num_mistakes
 
+''' Raised when a mistake list fails validation, with every problem found (see MistakeListValidator) '''
+class InvalidMistakeList(Exception):
+  MAX_REPORTED = 20
+
+  def __init__(self, source, violations):
+    self.source = source
+    self.violations = violations
+    if len(violations) == 1:
+      message = violations[0]
+    else:
+      lines = violations[:self.MAX_REPORTED]
+      if len(violations) > len(lines):
+        lines.append(f'... and {len(violations) - len(lines)} more')
+      message = '\n'.join([f'{len(violations)} problems in {source}:'] + lines)
+    super().__init__(message)
+
+  # Exceptions raised in the scoring workers are pickled back to the parent
+  def __reduce__(self):
+    return (InvalidMistakeList, (self.source, self.violations))
+
+"""
+  Checks mistake list rows (as for create_mistake_dict_from_rows()) before they are parsed, and finds
+    every problem rather than stopping at the first:
+  - rows without token ids, and rows whose tokenization (BOTH, SENT or DOC) differs from the first row's
+  - token ids which are not in the token lookup, or (in BOTH mode) do not agree with it
+  - spans (in the given categories) which overlap a span on an earlier row
+  Rows can be checked in several batches (e.g. one text at a time), the tokenization must be consistent
+    across all of them.  Rows which pass can then be parsed with validated=True.
+"""
+class MistakeListValidator:
+  def __init__(self, categories, token_lookup, source='rows'):
+    self.categories = categories
+    self.token_lookup = token_lookup
+    self.source = source
+    self.tokenization_mode = None
+    self.tokenization_row = None
+    # (row number, message)
+    self._violations = []
+
+  def _add(self, i, message):
+    self._violations.append((i, message))
+
+  ''' Returns the problems found so far, in row order '''
+  def violations(self):
+    return [message for _, message in sorted(self._violations, key=lambda v: v[0])]
+
+  ''' Raises InvalidMistakeList if any problems have been found '''
+  def raise_if_invalid(self):
+    if self._violations:
+      raise InvalidMistakeList(self.source, self.violations())
+
+  ''' Checks which token ids a row gives, returns its tokenization mode (None for a row without any) '''
+  def check_tokenization(self, i, row):
+    mode = row_tokenization_mode(row)
+    if mode is None:
+      self._add(i, f'You must provide either document or sentence based token ids on {self.source} row {i}')
+    elif self.tokenization_mode is None:
+      self.tokenization_mode, self.tokenization_row = mode, i
+    elif mode != self.tokenization_mode:
+      self._add(i, (
+        'You must consistently use either document-based, sentence-based or both for the tokenization method'
+        f' ({self.source} row {i} is {mode}, row {self.tokenization_row} is {self.tokenization_mode})'
+      ))
+    return mode
+
+  ''' Returns (doc_start_idx, doc_end_idx) for a row, or None after recording why it is invalid '''
+  def _doc_span(self, i, row):
+    mode = self.check_tokenization(i, row)
+    if mode is None:
+      return None
+
+    text_id = row[0].replace('.txt','')
+    lookup = self.token_lookup
+    try:
+      sentence_id, sent_start_idx, sent_end_idx = csv_int(row[1]), csv_int(row[4]), csv_int(row[5])
+      doc_start_idx, doc_end_idx = csv_int(row[6]), csv_int(row[7])
+      if mode == 'BOTH':
+        if not (
+          doc_start_idx == lookup.sent_to_doc(text_id, sentence_id, sent_start_idx) and
+          doc_end_idx == lookup.sent_to_doc(text_id, sentence_id, sent_end_idx) and
+          (sentence_id, sent_start_idx) == lookup.doc_to_sent(text_id, doc_start_idx) and
+          sent_end_idx == lookup.doc_to_sent(text_id, doc_end_idx)[1]
+        ):
+          self._add(i, f'The sentence and document token ids on {self.source} row {i} do not agree with the token lookup for {text_id}')
+          return None
+      elif mode == 'SENT':
+        doc_start_idx = lookup.sent_to_doc(text_id, sentence_id, sent_start_idx)
+        doc_end_idx = lookup.sent_to_doc(text_id, sentence_id, sent_end_idx)
+      else:
+        lookup.doc_to_sent(text_id, doc_start_idx)
+        lookup.doc_to_sent(text_id, doc_end_idx)
+    except ValueError:
+      self._add(i, f'The token ids on {self.source} row {i} are not integers')
+      return None
+    except KeyError:
+      self._add(i, f'The token ids on {self.source} row {i} are not in the token lookup for {text_id}')
+      return None
+    return doc_start_idx, doc_end_idx
+
+  ''' Checks a batch of numbered rows, returns True if no problems were found in it '''
+  def check(self, numbered_rows):
+    num_violations = len(self._violations)
+    spans_used = {}
+    for i, row in numbered_rows:
+      doc_span = self._doc_span(i, row)
+      if doc_span is None or row[8] not in self.categories:
+        continue
+      # Each text's spans are kept sorted (see use_span()), an overlapping span is reported and left out
+      text_id = row[0].replace('.txt','')
+      if text_id not in spans_used:
+        spans_used[text_id] = ([], [])
+      x = use_span(spans_used[text_id], doc_span[0], doc_span[1])
+      if x != None:
+        self._add(i, f'Token {x} already used, duplicate on {text_id}:{i}')
+    return len(self._violations) == num_violations
+
 """
   Recall is when at least one submitted mistake overlaps the GSML mistake
   - once a submitted mistake has been used for correct recall, it cannot be used again (it is consumed).
   Precision is when a submitted mistake overlaps any GSML mistake.
+
+  Each GSML mistake (in file order) is matched with the first submitted mistake (in file order) which
+    overlaps it and has not been consumed yet.
+  Submitted spans cannot overlap each other, so once sorted by start they are also sorted by end, and the
+    spans overlapping a GSML mistake are a contiguous run found by binary search on the ends.
+  Runs only share spans at their edges (the GSML spans cannot overlap either), so each text takes
+    O((G+S) log S) rather than comparing every pair of mistakes.
 """
 def match_mistake_dicts(gsml, submitted):
   per_category_matches = {k:{} for k in all_categories()}
 
-  # Copy this because the algorithm consumes elements
-  # - this can break the token level calcs if done in wrong order
-  # - so copy for least surprise
-  copy_submitted = deepcopy(submitted)
-
   for text_id, gsml_text_data in gsml.items():
-    # mistake level - match each submission to at most one gold mistake
-    used_submissions = set([])
-    for doc_start_idx, gsml_error_data in gsml_text_data.items():
-      doc_end_idx = gsml_error_data['doc_end_idx']
-      category = gsml_error_data['category']
+    matches, _ = match_text(text_id, gsml_text_data, submitted.get(text_id, {}))
+    for gsml_error_data, submitted_error_data in matches:
+      category = gsml_error_data.category
       assert category in per_category_matches
-
-      pop_key = None
-      if text_id in copy_submitted:
-        for submitted_doc_start_idx, submitted_error_data in copy_submitted[text_id].items():
-          # TODO - this is pretty brute force, it loops needlessly, but it works so ...
-
-          # Check if the submitted error intersects the GSML error 
-          if submitted_error_data['set'].intersection(gsml_error_data['set']):
-            # Only use a submission once, it cannot recall multiple gold mistakes
-            pop_key = submitted_doc_start_idx
-            break
-
-      match = pop_key != None
-      if match:
-        # Remove the submission so it will not be used again
-        copy_submitted[text_id].pop(pop_key, None)
-
-      per_category_matches[category][f'{text_id}_{doc_start_idx}'] = match
+      per_category_matches[category][f'{text_id}_{gsml_error_data.doc_start_idx}'] = submitted_error_data != None
   return per_category_matches
 
+"""
+  Matches the mistakes of one text, as described for match_mistake_dicts()
+  Returns a list of (GSML Mistake, the submitted Mistake which recalled it or None), in GSML order, and
+    the list of submitted Mistakes which were not consumed, in file order.
+"""
+def match_text(text_id, gsml_text_data, submitted_text_data):
+  submitted_list = list(submitted_text_data.values())
+  # (start, end, position in file) for the submitted spans, empty spans can never match
+  spans = sorted(
+    (error_data.doc_start_idx, error_data.doc_end_idx, rank)
+    for rank, error_data in enumerate(submitted_list)
+    if error_data.doc_end_idx >= error_data.doc_start_idx
+  )
+  ends = [end for _, end, _ in spans]
+  if any(ends[i] >= spans[i+1][0] for i in range(len(spans)-1)):
+    raise Exception(f'Submitted mistakes overlap on {text_id}, they must be created with create_mistake_dict()')
+
+  # The algorithm consumes submissions, so mark them here rather than altering submitted
+  consumed = bytearray(len(submitted_list))
+
+  # mistake level - match each submission to at most one gold mistake
+  matches = []
+  for gsml_error_data in gsml_text_data.values():
+    gsml_start_idx = gsml_error_data.doc_start_idx
+    gsml_end_idx = gsml_error_data.doc_end_idx
+
+    match_rank = None
+    if gsml_end_idx >= gsml_start_idx:
+      # Skip the spans which end before this GSML mistake starts, then walk those starting before it ends
+      pos = bisect_left(ends, gsml_start_idx)
+      while pos < len(spans) and spans[pos][0] <= gsml_end_idx:
+        # Only use a submission once, it cannot recall multiple gold mistakes
+        rank = spans[pos][2]
+        if not consumed[rank] and (match_rank is None or rank < match_rank):
+          match_rank = rank
+        pos += 1
+
+    if match_rank != None:
+      # Consume the submission so it will not be used again
+      consumed[match_rank] = 1
+      matches.append((gsml_error_data, submitted_list[match_rank]))
+    else:
+      matches.append((gsml_error_data, None))
+
+  unconsumed = [error_data for rank, error_data in enumerate(submitted_list) if not consumed[rank]]
+  return matches, unconsumed
+
 
 
 '''Returns the correct and incorrect recall totals'''
@@ -180,46 +425,74 @@ def get_recall(matches):
         incorrect[category] += 1
   return correct, incorrect
 
-def get_document_tokens(token_lookup):
-  document_tokens = {}
-  for text_id, token_data in token_lookup['doc_to_sent'].items():
-    document_tokens[text_id] = {}
-    for doc_token_id in token_data.keys():
-      document_tokens[text_id][doc_token_id] = {
-        'gsml': False,
-        'submitted': False
-      }
-  return document_tokens
+''' Returns the number of bits set in a bitset '''
+def popcount(bits):
+  return bin(bits).count('1')
 
-def match_tokens(data, document_tokens, mode):
-  for text_id, text_data in data.items():
-    for start_idx, error_data in text_data.items():
-      for x in range(error_data['doc_start_idx'], error_data['doc_end_idx']+1):
-        document_tokens[text_id][x][mode] = True
+"""
+  Returns the tokens covered by the mistakes in a mistake dict (created with create_mistake_dict()) as bitsets
+  The dictionary is structured as:
+  - TEXT_ID, CATEGORY_BITSETS
+    - CATEGORY, BITSET
+  Each bitset is an int where bit x is set when document token x is part of a mistake of that category.
+"""
+def get_token_bitsets(mistake_dict):
+  bitsets = {}
+  for text_id, text_data in mistake_dict.items():
+    category_bitsets = bitsets.setdefault(text_id, {})
+    for error_data in text_data.values():
+      span_len = error_data.doc_end_idx - error_data.doc_start_idx + 1
+      if span_len > 0:
+        span_bits = ((1 << span_len) - 1) << error_data.doc_start_idx
+        category_bitsets[error_data.category] = category_bitsets.get(error_data.category, 0) | span_bits
+  return bitsets
+
+''' Returns the union of the bitsets for the given categories '''
+def select_bitset(category_bitsets, categories):
+  bits = 0
+  for category, category_bits in category_bitsets.items():
+    if category in categories:
+      bits |= category_bits
+  return bits
 
-def get_token_level_result(gsml, submitted, token_lookup):
-  document_tokens = get_document_tokens(token_lookup)
-  match_tokens(gsml, document_tokens, 'gsml')
-  match_tokens(submitted, document_tokens, 'submitted')
-
-  recall = 0
-  recall_denominator = 0
-  precision_denominator = 0
-
-  for text_id, data in document_tokens.items():
-    for token_id, v in data.items():
-      if v['gsml'] and v['submitted']:
-        recall += 1
-      if v['gsml']:
-        recall_denominator += 1
-      if v['submitted']:
-        precision_denominator += 1
+"""
+  Returns a list of token level results, one for each list of categories in categories_list
+  The tokens of each text are held as one bitset per category, so each result is a few ORs, an AND
+    and popcounts per text, rather than a walk over every token.
+"""
+def get_token_level_results(gsml, submitted, token_lookup, categories_list):
+  gsml_bitsets = get_token_bitsets(gsml)
+  submitted_bitsets = get_token_bitsets(submitted)
+
+  # Only tokens in the token lookup are counted (ids start at 1)
+  # Only the texts with mistakes are visited, so scoring one text at a time does not walk the whole lookup
+  text_ids = [text_id for text_id in sorted(set(gsml_bitsets) | set(submitted_bitsets)) if text_id in token_lookup]
+  document_masks = {text_id: ((1 << (token_lookup.num_tokens(text_id)+1)) - 1) ^ 1 for text_id in text_ids}
+
+  results = []
+  for categories in categories_list:
+    recall = 0
+    recall_denominator = 0
+    precision_denominator = 0
+    for text_id in text_ids:
+      gsml_bits = select_bitset(gsml_bitsets.get(text_id, {}), categories) & document_masks[text_id]
+      submitted_bits = select_bitset(submitted_bitsets.get(text_id, {}), categories) & document_masks[text_id]
+      recall += popcount(gsml_bits & submitted_bits)
+      recall_denominator += popcount(gsml_bits)
+      precision_denominator += popcount(submitted_bits)
+    results.append({
+      'recall': recall,
+      'recall_denominator': recall_denominator,
+      'precision_denominator': precision_denominator,
+    })
+  return results
 
-  return {
-    'recall': recall,
-    'recall_denominator': recall_denominator,
-    'precision_denominator': precision_denominator,
-  }
+def get_token_level_result(gsml, submitted, token_lookup):
+  categories = set([])
+  for data in [gsml, submitted]:
+    for text_data in data.values():
+      categories.update(error_data.category for error_data in text_data.values())
+  return get_token_level_results(gsml, submitted, token_lookup, [categories])[0]
 
 def safe_divide(x, y):
   if y > 0:
@@ -227,44 +500,88 @@ def safe_divide(x, y):
   return None
 
 
+"""
+  Returns the raw text tokens of each text which has a file in text_dir, keyed by TEXT_ID
+  This is the TextStore shared by the whole process, so each text is only read once.
+"""
+def load_raw_tokens(text_dir, text_ids):
+  return text_store.get_text_store(text_dir).preload(text_ids)
+
 """
   checks that the token text in the submssion matches that which is retrieved by DOCUMENT level IDs
 """
 def check_token_ids(mistake_dict, text_dir):
+  check_raw_tokens(mistake_dict, load_raw_tokens(text_dir, mistake_dict.keys()))
+
+''' As check_token_ids(), against raw text tokens already loaded with load_raw_tokens() '''
+def check_raw_tokens(mistake_dict, raw_tokens):
   for text_id, text_errors in mistake_dict.items():
-    with open(f'{text_dir}/{text_id}.txt', 'r') as fh:
-      raw_text = fh.read()
-      raw_tokens = raw_text.split()
-      for doc_start_idx, h in text_errors.items():
-        assert doc_start_idx == h['doc_start_idx']
-        tokens = h['tokens'].split()
-        for i, t  in enumerate(tokens):
-          # Check the token reported matches the one in the raw text
-          # - Token IDs in submission start at 1 (because of WebAnno)
-          x = doc_start_idx+i-1
-          # print(f'{text_id}:{x} => {raw_tokens[doc_start_idx+i-1]} == {t}')
-          assert raw_tokens[x] == t
+    if text_id not in raw_tokens:
+      raise Exception(f'There is no raw text for {text_id}')
+    text_tokens = raw_tokens[text_id]
+    for doc_start_idx, h in text_errors.items():
+      assert doc_start_idx == h.doc_start_idx
+      tokens = h.tokens.split()
+      for i, t  in enumerate(tokens):
+        # Check the token reported matches the one in the raw text
+        # - Token IDs in submission start at 1 (because of WebAnno)
+        x = doc_start_idx+i-1
+        # print(f'{text_id}:{x} => {text_tokens[doc_start_idx+i-1]} == {t}')
+        assert text_tokens[x] == t
 
+"""
+  Returns the part of a mistake dict (created with create_mistake_dict()) in the given categories
+  The function returns a tuple where the first element is the dict, and the second is num_mistakes
+"""
+def select_categories(mistake_dict, categories):
+  selected = {}
+  num_mistakes = 0
+  for text_id, text_data in mistake_dict.items():
+    h = {k: v for k, v in text_data.items() if v.category in categories}
+    if h:
+      selected[text_id] = h
+      num_mistakes += len(h)
+  return selected, num_mistakes
 
 """
-  Returns a dict containing sub-dicts of recall, precision and overlaps between a GSML and a submission
-  Takes as input dicts created with match_mistake_dicts(), plus a list of categories
-  Only the categories given will be checked.
+  Returns the counts behind the results for one list of categories (see get_result())
+  Takes as input dicts created with create_mistake_dict(), already restricted to those categories,
+    and the token level result for them.
+  Mistakes are never matched across texts, so the counts for groups of texts can be computed separately
+    and combined with add_counts().
 """
-def calculate_recall_and_precision(gsml_filename, submitted_filename, token_lookup, text_dir, categories=[]):
-  gsml, gsml_num_lines = create_mistake_dict(gsml_filename, categories, token_lookup)
-  submitted, submitted_num_lines = create_mistake_dict(submitted_filename, categories, token_lookup)
+def get_counts(gsml, gsml_num_lines, submitted, submitted_num_lines, token_result):
+  per_category_matches = match_mistake_dicts(gsml, submitted)
+  correct_recall_h, incorrect_recall_h = get_recall(per_category_matches)
+  return {
+    'gsml_num_lines': gsml_num_lines,
+    'submitted_num_lines': submitted_num_lines,
+    'correct_recall': correct_recall_h,
+    'incorrect_recall': incorrect_recall_h,
+    'token': token_result,
+  }
 
-  if text_dir != None:
-    print('\tChecking GSML for token match against raw texts:')
-    check_token_ids(gsml, text_dir)
-    print('\tChecking Submitted for token match against raw texts:')
-    check_token_ids(submitted, text_dir)
+''' Returns the sum of two sets of counts (see get_counts()) '''
+def add_counts(counts, other):
+  return {
+    'gsml_num_lines': counts['gsml_num_lines'] + other['gsml_num_lines'],
+    'submitted_num_lines': counts['submitted_num_lines'] + other['submitted_num_lines'],
+    'correct_recall': {k: v + other['correct_recall'][k] for k, v in counts['correct_recall'].items()},
+    'incorrect_recall': {k: v + other['incorrect_recall'][k] for k, v in counts['incorrect_recall'].items()},
+    'token': {k: v + other['token'][k] for k, v in counts['token'].items()},
+  }
 
-  # Mistake level
-  per_category_matches = match_mistake_dicts(gsml, submitted)
+"""
+  Returns the dict of results for one list of categories (see calculate_recall_and_precision())
+  Takes as input the counts from get_counts()
+"""
+def get_result(counts):
+  gsml_num_lines = counts['gsml_num_lines']
+  submitted_num_lines = counts['submitted_num_lines']
+  token_result = counts['token']
 
-  correct_recall_h, incorrect_recall_h = get_recall(per_category_matches)
+  # Mistake level
+  correct_recall_h, incorrect_recall_h = counts['correct_recall'], counts['incorrect_recall']
   correct_recall = sum(correct_recall_h.values())
   incorrect_recall = sum(incorrect_recall_h.values())
 
@@ -274,7 +591,6 @@ def calculate_recall_and_precision(gsml_filename, submitted_filename, token_look
   precision = safe_divide(correct_recall, submitted_num_lines)
 
   # Token level
-  token_result = get_token_level_result(gsml, submitted, token_lookup)
   token_recall = safe_divide(token_result['recall'], token_result['recall_denominator'])
   token_precision = safe_divide(token_result['recall'], token_result['precision_denominator'])
 
@@ -304,97 +620,731 @@ def calculate_recall_and_precision(gsml_filename, submitted_filename, token_look
     'incorrect_recall_debug': incorrect_recall_h
   }
 
-def format_result_value(value, dcp=3):
-  if value:
-    return round(value, dcp)
-  return None
-
-
-
-
+''' Returns the set of every category in a list of lists of categories '''
+def requested_categories(categories_list):
+  all_requested = set([])
+  for categories in categories_list:
+    all_requested.update(categories)
+  return all_requested
 
+''' Returns the part of a mistake dict (created with create_mistake_dict()) for the given texts '''
+def select_texts(mistake_dict, text_ids):
+  return {text_id: mistake_dict[text_id] for text_id in text_ids if text_id in mistake_dict}
 
+"""
+  Reads a mistake list (GSML or Submission) and checks it against the raw text tokens (when given)
+  source is either a CSV filename or in-memory rows (see iterate_rows()).  Rows already read from a
+    CSV can be given as numbered_rows, source is then only used in error messages.
+  The rows are validated once, raising InvalidMistakeList with every problem found (see
+    MistakeListValidator), then parsed without the per-row checks.
+  Returns the mistake dict for the given categories.
+"""
+def read_mistake_list(source, token_lookup, raw_tokens, categories, numbered_rows=None):
+  if numbered_rows != None:
+    numbered_rows = list(numbered_rows)
+  elif isinstance(source, (str, os.PathLike)):
+    numbered_rows = list(iterate_numbered_rows(source))
+  else:
+    numbered_rows = list(enumerate(iterate_rows(source)))
+    source = 'rows'
+  with profiling.stage('validate'):
+    validator = MistakeListValidator(categories, token_lookup, source)
+    validator.check(numbered_rows)
+    validator.raise_if_invalid()
+  with profiling.stage('parse'):
+    mistake_dict, _ = create_mistake_dict_from_rows(numbered_rows, categories, token_lookup, source, validated=True)
+  if raw_tokens != None:
+    with profiling.stage('check_raw_tokens'):
+      check_raw_tokens(mistake_dict, raw_tokens)
+  return mistake_dict
 
+"""
+  Returns a list of counts (see get_counts()), one for each list of categories in categories_list
+  The tokens are scored for every list of categories together, then each list is matched separately
+    (which submissions get consumed depends on the categories).
+"""
+def count_mistake_dicts(gsml, submitted, token_lookup, categories_list):
+  with profiling.stage('token_level'):
+    token_results = get_token_level_results(gsml, submitted, token_lookup, categories_list)
+
+  counts_list = []
+  for categories, token_result in zip(categories_list, token_results):
+    with profiling.stage(f'categories:{"|".join(categories)}'):
+      gsml_selected, gsml_num_lines = select_categories(gsml, categories)
+      submitted_selected, submitted_num_lines = select_categories(submitted, categories)
+      counts_list.append(get_counts(gsml_selected, gsml_num_lines, submitted_selected, submitted_num_lines, token_result))
+  return counts_list
 
-# CLI args
-parser.add_argument('--gsml', type=str,
-                    help='The GSML file path (CSV)')
+"""
+  Writes the match records (see match_export) of the given texts to a match_export.MatchWriter
+  The mistakes are matched as for the categories given scored together, from the mistake dicts the
+    submission was scored from, so nothing is read again.
+"""
+def write_match_records(writer, gsml, submitted, text_ids, categories):
+  with profiling.stage('match_records'):
+    for text_id in text_ids:
+      gsml_text_data = {k: v for k, v in gsml.get(text_id, {}).items() if v.category in categories}
+      submitted_text_data = {k: v for k, v in submitted.get(text_id, {}).items() if v.category in categories}
+      if gsml_text_data or submitted_text_data:
+        matches, unconsumed = match_text(text_id, gsml_text_data, submitted_text_data)
+        writer.write(match_export.text_records(text_id, matches, unconsumed))
+
+''' Raised by group_rows_by_text() when the rows of a text are not all together '''
+class UnsortedMistakeList(Exception):
+  pass
+
+''' Returns 'BOTH', 'SENT', 'DOC' or None, for the token ids given on a row (as in create_mistake_dict_from_rows()) '''
+def row_tokenization_mode(row):
+  sent_given = (row[4] != '' and row[5] != '' and row[1] != '')
+  doc_given = (row[6] != '' and row[7] != '')
+  if sent_given and doc_given:
+    return 'BOTH'
+  elif sent_given:
+    return 'SENT'
+  elif doc_given:
+    return 'DOC'
+  return None
 
-parser.add_argument('--submitted', type=str, nargs='?',
-                    help='The submitted file path (CSV)')
+''' Yields the (row number, row) pairs of a mistake list CSV, without the header '''
+def iterate_numbered_rows(filename):
+  with open(filename, newline='') as csvfile:
+    reader = csv.reader(csvfile, delimiter=',', quotechar='"')
+    next(reader, None)
+    for numbered_row in enumerate(reader):
+      yield numbered_row
+
+''' Sort key for numbered rows: TEXT_ID, then row number '''
+def text_order(numbered_row):
+  return numbered_row[1][0].replace('.txt',''), numbered_row[0]
+
+''' Writes sorted numbered rows to a temporary CSV, returns its filename '''
+def write_sorted_run(numbered_rows, tmp_dir):
+  fd, filename = tempfile.mkstemp(suffix='.csv', dir=tmp_dir)
+  with os.fdopen(fd, 'w', newline='') as fh:
+    writer = csv.writer(fh)
+    for i, row in sorted(numbered_rows, key=text_order):
+      writer.writerow([i] + row)
+  return filename
+
+''' Yields the numbered rows written by write_sorted_run() '''
+def iterate_sorted_run(filename):
+  with open(filename, newline='') as fh:
+    for row in csv.reader(fh):
+      yield int(row[0]), row[1:]
 
-parser.add_argument('--token_lookup', type=str,
-                    help='The tokenization file (YAML)')
+"""
+  Yields the (row number, row) pairs of a mistake list CSV ordered by TEXT_ID, then row number.
+  This is an external merge sort: runs of chunk_rows rows are sorted in memory and written to temporary
+    files, which are then merged, so memory is bounded by chunk_rows rather than by the size of the file.
+"""
+def iterate_rows_sorted_by_text(filename, chunk_rows):
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    runs = []
+    chunk = []
+    for numbered_row in iterate_numbered_rows(filename):
+      chunk.append(numbered_row)
+      if len(chunk) >= chunk_rows:
+        runs.append(write_sorted_run(chunk, tmp_dir))
+        chunk = []
+
+    if not runs:
+      # Small enough to sort in memory
+      for numbered_row in sorted(chunk, key=text_order):
+        yield numbered_row
+      return
+
+    if chunk:
+      runs.append(write_sorted_run(chunk, tmp_dir))
+      chunk = []
+    for numbered_row in heapq.merge(*[iterate_sorted_run(f) for f in runs], key=text_order):
+      yield numbered_row
 
-parser.add_argument('--text_dir', type=str,
-                    help='The directory where the raw texts are')
+"""
+  Groups consecutive numbered rows by TEXT_ID, yielding (text_id, [(row number, row), ...]) for each text
+  Raises UnsortedMistakeList if a text has rows after those of another text.
+"""
+def group_rows_by_text(numbered_rows):
+  finished = set([])
+  text_id = None
+  group = []
+  for i, row in numbered_rows:
+    row_text_id = row[0].replace('.txt','')
+    if row_text_id != text_id:
+      if group:
+        yield text_id, group
+        finished.add(text_id)
+      if row_text_id in finished:
+        raise UnsortedMistakeList(f'The rows for {row_text_id} are not together (row {i})')
+      text_id = row_text_id
+      group = []
+    group.append((i, row))
+  if group:
+    yield text_id, group
 
-parser.add_argument('--csv_out', type=str,
-                    help='Path to an output CSV file for stats (optional)')
+"""
+  Shared, read-only state for the scoring workers of Evaluator.score_files()
+  It is filled in before the process pool is created, so the forked workers inherit it (including the
+    memory-mapped token lookup) rather than having it pickled to them.
+"""
+_worker_state = {}
+
+''' Worker: reads and counts a whole submission, returns (the list of counts, the task's profile or None) '''
+def _count_submission(submitted_filename):
+  state = _worker_state
+  evaluator = state['evaluator']
+  with profiling.worker_profile() as profile:
+    if state['stream']:
+      counts_list = evaluator.count_stream(submitted_filename, state['categories_list'], cache=state['cache'])
+    else:
+      counts_list = evaluator.count_file(submitted_filename, state['categories_list'])
+  return counts_list, profile and profile.to_dict()
+
+''' Worker: counts a group of texts of the submission which was read before forking, returns as _count_submission() '''
+def _count_texts(text_ids):
+  state = _worker_state
+  evaluator = state['evaluator']
+  with profiling.worker_profile() as profile:
+    gsml = select_texts(evaluator.gsml, text_ids)
+    submitted = select_texts(state['submitted'], text_ids)
+    with profiling.stage('count'):
+      counts_list = count_mistake_dicts(gsml, submitted, evaluator.token_lookup, state['categories_list'])
+  return counts_list, profile and profile.to_dict()
 
-args = parser.parse_args()
-gsml_filename = args.gsml
-submitted_filename = args.submitted
-token_lookup_filename = args.token_lookup
-text_dir = args.text_dir
-csv_out = args.csv_out
+"""
+  Returns the lists of counts from the results of worker tasks
+  The stages profiled in the workers are added to the active profile under 'workers/', with their times
+    summed across the workers.
+"""
+def collect_worker_results(task_results):
+  profile = profiling.active()
+  counts_lists = []
+  for counts_list, task_profile in task_results:
+    counts_lists.append(counts_list)
+    if profile != None and task_profile != None:
+      profile.merge(task_profile, 'workers')
+  return counts_lists
+
+''' Returns the element-wise sum of lists of counts, in the order given '''
+def merge_counts_lists(counts_lists):
+  merged = counts_lists[0]
+  for counts_list in counts_lists[1:]:
+    merged = [add_counts(a, b) for a, b in zip(merged, counts_list)]
+  return merged
+
+''' The lists of categories the CLI reports: all categories combined, then each category individually '''
+def default_categories_list():
+  return [all_categories()] + [[x] for x in all_categories()]
 
-with open(token_lookup_filename, 'r') as fh:
-  token_lookup = yaml.full_load(fh)
+"""
+  Scores submissions against one GSML.
+  The token lookup and the GSML are loaded once, when the Evaluator is created, and each raw text (and
+    token lookup shard) is read once, the first time it is needed.  Scoring prints nothing:
+
+    evaluator = Evaluator('gsml.csv', 'token_lookup.yaml', text_dir='texts')
+    results = evaluator.score([('S001', None, None, 'Wednesday', None, None, 18, 18, 'NAME'), ...])
+
+  gsml is a CSV filename or in-memory rows (see iterate_rows()), token_lookup is the YAML filename or a
+    TokenIndex, and text_dir (optional) is where the raw texts are, to check the TOKENS column against.
+    Without a token lookup, it is derived from the raw texts (see token_index.index_from_texts()).
+  Submissions can be scored for any lists of categories within categories_list (default: all
+    categories combined, then each one individually), results are one dict per list of categories, in
+    the format of calculate_recall_and_precision().
+"""
+class Evaluator:
+  def __init__(self, gsml, token_lookup, text_dir=None, categories_list=None):
+    if token_lookup is None:
+      if text_dir is None:
+        raise Exception('Either a token lookup or the directory of raw texts is needed')
+      with profiling.stage('load_token_lookup'):
+        store = text_store.get_text_store(text_dir)
+        token_lookup = token_index.index_from_texts(store, store.text_ids())
+    elif isinstance(token_lookup, (str, os.PathLike)):
+      with profiling.stage('load_token_lookup'):
+        token_lookup = token_index.load_token_lookup(token_lookup)
+    self.token_lookup = token_lookup
+    self.categories_list = categories_list or default_categories_list()
+    self.categories = requested_categories(self.categories_list)
+    self.raw_tokens = None
+    self._text_digests = {}
+    if text_dir != None:
+      # The store reads each text the first time it is checked against, so only the texts of the GSML
+      # and the submissions are ever read
+      with profiling.stage('load_raw_texts'):
+        self.raw_tokens = text_store.get_text_store(text_dir)
+    with profiling.stage('read_gsml'):
+      self.gsml = read_mistake_list(gsml, token_lookup, self.raw_tokens, self.categories)
+
+  def _categories_list(self, categories_list):
+    if categories_list is None:
+      return self.categories_list
+    if not requested_categories(categories_list) <= self.categories:
+      raise Exception(f'The GSML was only loaded for the categories {sorted(self.categories)}')
+    return categories_list
+
+  ''' Returns the list of counts (see get_counts()) for an in-memory submission '''
+  def count(self, rows, categories_list=None):
+    categories_list = self._categories_list(categories_list)
+    with profiling.stage('read_submitted'):
+      submitted = read_mistake_list(rows, self.token_lookup, self.raw_tokens, requested_categories(categories_list))
+    with profiling.stage('count'):
+      return count_mistake_dicts(self.gsml, submitted, self.token_lookup, categories_list)
+
+  ''' Returns the list of counts (see get_counts()) for (row number, row) pairs read from source, e.g. part of a submission CSV '''
+  def count_numbered_rows(self, numbered_rows, source, categories_list=None):
+    categories_list = self._categories_list(categories_list)
+    with profiling.stage('read_submitted'):
+      submitted = read_mistake_list(source, self.token_lookup, self.raw_tokens, requested_categories(categories_list), numbered_rows)
+    with profiling.stage('count'):
+      return count_mistake_dicts(self.gsml, submitted, self.token_lookup, categories_list)
+
+  """
+    Returns the list of counts (see get_counts()) for a submission CSV
+    With a writer (a match_export.MatchWriter), the match records of every text are written to it too,
+      for all the categories of categories_list scored together.
+  """
+  def count_file(self, submitted_filename, categories_list=None, writer=None):
+    categories_list = self._categories_list(categories_list)
+    with profiling.stage('read_submitted'):
+      submitted = read_mistake_list(submitted_filename, self.token_lookup, self.raw_tokens, requested_categories(categories_list))
+    with profiling.stage('count'):
+      counts_list = count_mistake_dicts(self.gsml, submitted, self.token_lookup, categories_list)
+    if writer != None:
+      write_match_records(writer, self.gsml, submitted, sorted(set(self.gsml) | set(submitted)), requested_categories(categories_list))
+    return counts_list
+
+  """
+    Returns the list of counts (see get_counts()) for a submission CSV, read one text at a time.
+    Each text's rows are parsed, checked and scored, then released, so memory is bounded by the largest
+      text rather than the whole file.  A file whose rows are not grouped by TEXT_ID is first sorted
+      with iterate_rows_sorted_by_text(), holding chunk_rows rows at a time.
+    Errors report the row numbers of the original file.
+    With a cache (a ResultCache), the counts for each text are looked up by text_cache_key(), and only
+      the texts whose inputs have changed since they were cached are parsed and scored.
+    With a writer, the match records of each text are written as it is scored (see count_file()), the
+      texts without submitted rows last.  The texts found in the cache are still parsed for them.
+  """
+  def count_stream(self, submitted_filename, categories_list=None, chunk_rows=100000, cache=None, writer=None):
+    categories_list = self._categories_list(categories_list)
+    try:
+      groups = group_rows_by_text(iterate_numbered_rows(submitted_filename))
+      return self._count_text_groups(groups, submitted_filename, categories_list, cache, writer)
+    except UnsortedMistakeList:
+      groups = group_rows_by_text(iterate_rows_sorted_by_text(submitted_filename, chunk_rows))
+      return self._count_text_groups(groups, submitted_filename, categories_list, cache, writer)
+
+  """
+    Returns the cache key for the counts of one text, a hash of everything they depend on: the text's
+      GSML mistakes and submitted rows, its slice of the token lookup, its raw text (when it is
+      checked) and the lists of categories.
+    The GSML and token lookup part is the same for every run of this Evaluator, so it is hashed once.
+  """
+  def text_cache_key(self, text_id, rows, categories_list):
+    fixed_digest = self._text_digests.get(text_id)
+    if fixed_digest is None:
+      gsml_mistakes = [
+        [m.doc_start_idx, m.doc_end_idx, m.sentence_id, m.sent_start_idx, m.sent_end_idx, m.category, m.annotation_id, m.tokens]
+        for m in self.gsml.get(text_id, {}).values()
+      ]
+      token_lookup_bytes = self.token_lookup.text_bytes(text_id) if text_id in self.token_lookup else b''
+      fixed_digest = result_cache.digest([gsml_mistakes, token_lookup_bytes])
+      self._text_digests[text_id] = fixed_digest
+    raw_text = None
+    if self.raw_tokens != None and text_id in self.raw_tokens:
+      raw_text = self.raw_tokens.text(text_id)
+    return result_cache.digest([
+      result_cache.CACHE_VERSION, text_id, categories_list, fixed_digest, rows, raw_text,
+    ])
+
+  def _count_text_groups(self, groups, source, categories_list, cache=None, writer=None):
+    categories = requested_categories(categories_list)
+    counts_list = count_mistake_dicts({}, {}, self.token_lookup, categories_list)
+    validator = MistakeListValidator(categories, self.token_lookup, source)
+    counted = set([])
+
+    try:
+      for text_id, numbered_rows in groups:
+        text_counts = None
+        if cache != None:
+          with profiling.stage('cache_get'):
+            key = self.text_cache_key(text_id, [row for _, row in numbered_rows], categories_list)
+            text_counts = cache.get(key)
+
+        if text_counts != None:
+          # The rows were valid when they were cached, but the tokenization must be consistent across texts too
+          validator.check_tokenization(*numbered_rows[0])
+          if writer != None:
+            # The cache only keeps the counts, the records need the mistakes
+            with profiling.stage('read_submitted'):
+              submitted, _ = create_mistake_dict_from_rows(numbered_rows, categories, self.token_lookup, source, validated=True)
+        else:
+          # After a problem the remaining texts are only validated, so that every problem is reported
+          with profiling.stage('validate'):
+            if not validator.check(numbered_rows) or validator.violations():
+              continue
+          with profiling.stage('read_submitted'):
+            with profiling.stage('parse'):
+              submitted, _ = create_mistake_dict_from_rows(numbered_rows, categories, self.token_lookup, source, validated=True)
+            if self.raw_tokens != None:
+              with profiling.stage('check_raw_tokens'):
+                check_raw_tokens(submitted, self.raw_tokens)
+          with profiling.stage('count'):
+            text_counts = count_mistake_dicts(select_texts(self.gsml, [text_id]), submitted, self.token_lookup, categories_list)
+          if cache != None:
+            with profiling.stage('cache_put'):
+              cache.put(key, text_counts)
+        if writer != None:
+          write_match_records(writer, self.gsml, submitted, [text_id], categories)
+        counts_list = [add_counts(a, b) for a, b in zip(counts_list, text_counts)]
+        counted.add(text_id)
+    finally:
+      if cache != None:
+        # The new counts and the times of the ones read are written together, once per run
+        with profiling.stage('cache_flush'):
+          cache.flush()
+
+    validator.raise_if_invalid()
+
+    # GSML texts without any submitted rows
+    missed = [text_id for text_id in self.gsml if text_id not in counted]
+    with profiling.stage('count'):
+      missed_counts = count_mistake_dicts(select_texts(self.gsml, missed), {}, self.token_lookup, categories_list)
+    if writer != None:
+      write_match_records(writer, self.gsml, {}, missed, categories)
+    return [add_counts(a, b) for a, b in zip(counts_list, missed_counts)]
+
+  ''' Returns the list of result dicts for a submission CSV, read one text at a time (see count_stream()) '''
+  def score_stream(self, submitted_filename, categories_list=None, chunk_rows=100000, cache=None, writer=None):
+    return [get_result(counts) for counts in self.count_stream(submitted_filename, categories_list, chunk_rows, cache, writer)]
+
+  ''' Returns the list of result dicts for an in-memory submission '''
+  def score(self, rows, categories_list=None):
+    return [get_result(counts) for counts in self.count(rows, categories_list)]
+
+  ''' Returns the list of result dicts for a submission CSV (see count_file()) '''
+  def score_file(self, submitted_filename, categories_list=None, writer=None):
+    return [get_result(counts) for counts in self.count_file(submitted_filename, categories_list, writer)]
+
+  """
+    Returns {TEXT_ID: list of counts} for a submission (CSV filename or in-memory rows), for every text
+      in the token lookup (texts with no mistakes have zero counts), and any other text with a mistake.
+      The counts of all the texts add up to count_file().
+    These are what bootstrap.bootstrap_results() and bootstrap.paired_bootstrap() resample, so a text
+      with no mistakes is still drawn, as it would be from the population of texts.
+    With a writer, the match records are written too (see count_file()).
+  """
+  def count_per_text(self, submitted, categories_list=None, writer=None):
+    categories_list = self._categories_list(categories_list)
+    with profiling.stage('read_submitted'):
+      submitted = read_mistake_list(submitted, self.token_lookup, self.raw_tokens, requested_categories(categories_list))
+    text_ids = sorted(set(self.token_lookup.text_ids()) | set(self.gsml.keys()) | set(submitted.keys()))
+    with profiling.stage('count'):
+      per_text = {
+        text_id: count_mistake_dicts(select_texts(self.gsml, [text_id]), select_texts(submitted, [text_id]), self.token_lookup, categories_list)
+        for text_id in text_ids
+      }
+    if writer != None:
+      write_match_records(writer, self.gsml, submitted, text_ids, requested_categories(categories_list))
+    return per_text
+
+  """
+    Returns a list with the results of score_file() for each submission CSV.
+    With more than one worker the scoring is spread across a pool of forked processes:
+    - several submissions are scored one per task
+    - a single submission is read here, then its texts are split into groups, one per task
+    The counts are integers merged in task order, so the results are identical to a serial run.
+    Where processes cannot be forked, the submissions are scored serially.
+    With stream, each submission is read one text at a time (see count_stream()), and a single
+      submission is scored in this process.  A cache (see count_stream()) implies stream.
+    writers are match_export.MatchWriters, one for each submission, to write its match records to
+      (see count_file()).  The records are written in this process, so with writers several submissions
+      are scored serially.
+  """
+  def score_files(self, submitted_filenames, categories_list=None, workers=1, stream=False, cache=None, writers=None):
+    categories_list = self._categories_list(categories_list)
+    stream = stream or cache != None
+    serial = workers <= 1 or (len(submitted_filenames) == 1 and stream) or (len(submitted_filenames) > 1 and writers != None)
+    if writers is None:
+      writers = [None] * len(submitted_filenames)
+    if serial or 'fork' not in multiprocessing.get_all_start_methods():
+      if stream:
+        return [self.score_stream(f, categories_list, cache=cache, writer=w) for f, w in zip(submitted_filenames, writers)]
+      return [self.score_file(f, categories_list, w) for f, w in zip(submitted_filenames, writers)]
+
+    _worker_state.update({
+      'evaluator': self,
+      'categories_list': categories_list,
+      'stream': stream,
+      'cache': cache,
+    })
+    try:
+      if len(submitted_filenames) > 1:
+        with multiprocessing.get_context('fork').Pool(workers) as pool:
+          counts_lists = collect_worker_results(pool.map(_count_submission, submitted_filenames))
+        return [[get_result(counts) for counts in counts_list] for counts_list in counts_lists]
+
+      with profiling.stage('read_submitted'):
+        submitted = read_mistake_list(submitted_filenames[0], self.token_lookup, self.raw_tokens, requested_categories(categories_list))
+      _worker_state['submitted'] = submitted
+      text_ids = sorted(set(self.gsml.keys()) | set(submitted.keys()))
+      groups = [text_ids[i::workers] for i in range(workers)]
+      with multiprocessing.get_context('fork').Pool(workers) as pool:
+        counts_lists = collect_worker_results(pool.map(_count_texts, groups))
+      if writers[0] != None:
+        write_match_records(writers[0], self.gsml, submitted, text_ids, requested_categories(categories_list))
+      return [[get_result(counts) for counts in merge_counts_lists(counts_lists)]]
+    finally:
+      _worker_state.clear()
 
-print('\n\n')
-print('-' * 80)
-print('GSML: EVALUATE')
-print(f'comparing GSML => "{gsml_filename}" to submission => "{submitted_filename}"')
+"""
+  Returns a list of result dicts (see calculate_recall_and_precision()), one for each list of categories
+    in categories_list.
+  The GSML and the submission are read, validated and checked against the raw texts once, for the union
+    of all the categories, then every list of categories is scored from them.
+  Note that overlapping spans are checked across that union, so an overlap between two categories is
+    rejected even when they are never scored together.
+"""
+def calculate_recall_and_precision_for_categories(gsml_filename, submitted_filename, token_lookup, text_dir, categories_list):
+  return Evaluator(gsml_filename, token_lookup, text_dir, categories_list).score_file(submitted_filename)
 
-# Check all catogories combined, as well as each category individually
-categories_list = [all_categories()] + [[x] for x in all_categories()]
-csv_lines = [
-  [
-    'categories',
-    'recall',
-    'precision',
-    'token_recall',
-    'token_precision',
-    'submitted_filename',
-    'gsml_filename',
-    'token_lookup_filename',
-    'text_dir',
-  ]
-]
+"""
+  Returns a dict containing sub-dicts of recall, precision and overlaps between a GSML and a submission
+  Takes as input dicts created with match_mistake_dicts(), plus a list of categories
+  Only the categories given will be checked.
+"""
+def calculate_recall_and_precision(gsml_filename, submitted_filename, token_lookup, text_dir, categories=[]):
+  return calculate_recall_and_precision_for_categories(gsml_filename, submitted_filename, token_lookup, text_dir, [categories])[0]
 
-for categories in categories_list:
-  category_display_str = ', '.join(categories)
-  print('\n\n--------------------------------------------')
-  print(f'-- GSML for categories: [{category_display_str}]')
+def format_result_value(value, dcp=3):
+  if value:
+    return round(value, dcp)
+  return None
 
-  result = calculate_recall_and_precision(gsml_filename, submitted_filename, token_lookup, text_dir, categories)
-  recall = format_result_value(result['recall']['value'])
-  precision = format_result_value(result['precision']['value'])
-  token_recall = format_result_value(result['token_recall']['value'])
-  token_precision = format_result_value(result['token_precision']['value'])
+''' As format_result_value(), but for differences and interval bounds, which can be zero (or negative) '''
+def format_difference(value, dcp=3):
+  if value is None:
+    return None
+  return round(value, dcp)
 
-  csv_lines.append(
+"""
+  Returns the submission files to score for the --submitted argument, which can be a file,
+    a directory (every .csv file in it) or a glob pattern.
+"""
+def expand_submitted_filenames(submitted_arg):
+  if os.path.isdir(submitted_arg):
+    filenames = sorted(glob.glob(os.path.join(submitted_arg, '*.csv')))
+  elif glob.has_magic(submitted_arg):
+    filenames = sorted(glob.glob(submitted_arg))
+  else:
+    filenames = [submitted_arg]
+
+  if len(filenames) == 0:
+    raise Exception(f'No submission files found for {submitted_arg}')
+  return filenames
+
+def main():
+  # Instantiate the parser
+  parser = argparse.ArgumentParser(description='Optional app description')
+
+  # CLI args
+  parser.add_argument('--gsml', type=str,
+                      help='The GSML file path (CSV)')
+
+  parser.add_argument('--submitted', type=str, nargs='?',
+                      help='The submitted file path (CSV), or a directory or glob pattern of submissions to score in one run')
+
+  parser.add_argument('--token_lookup', type=str,
+                      help='The tokenization file (YAML), a compiled index is kept alongside it, or a directory of shards built with token_index.py --shards (default: derived from the texts in --text_dir)')
+
+  parser.add_argument('--text_dir', type=str,
+                      help='The directory where the raw texts are')
+
+  parser.add_argument('--csv_out', type=str,
+                      help='Path to an output CSV file for stats (optional), with rows for every submission')
+
+  parser.add_argument('--workers', type=int, default=1,
+                      help='Number of processes to score with (default 1)')
+
+  parser.add_argument('--stream', action='store_true',
+                      help='Read submissions one text at a time, for submissions too large to hold in memory')
+
+  parser.add_argument('--cache', type=str,
+                      help='Path to a cache file of per-text results, so re-runs only score the texts whose inputs changed (implies --stream)')
+
+  parser.add_argument('--cache_max_mb', type=float, default=result_cache.DEFAULT_MAX_BYTES / (1024 * 1024),
+                      help='Size the cache is kept within, least recently used results are evicted first (default 64)')
+
+  parser.add_argument('--profile', type=str,
+                      help='Path to an output JSON file with the results, and the time, calls and peak memory of each stage')
+
+  parser.add_argument('--bootstrap', type=int, default=0,
+                      help='Number of text level bootstrap resamples, to give confidence intervals for the results (e.g. 10000), not with --workers, --stream or --cache')
+
+  parser.add_argument('--confidence', type=float, default=0.95,
+                      help='Level of the bootstrap confidence intervals (default 0.95)')
+
+  parser.add_argument('--bootstrap_baseline', type=str,
+                      help='A submission (CSV) to compare each submission with, by paired bootstrap (needs --bootstrap)')
+
+  parser.add_argument('--seed', type=int, default=0,
+                      help='Random seed of the bootstrap resamples (default 0)')
+
+  parser.add_argument('--matches_out', type=str,
+                      help='Directory to write a record of every GSML mistake and unmatched submission to, for error analysis (a sub-directory per submission when there are several)')
+
+  parser.add_argument('--matches_chunk_rows', type=int, default=1000000,
+                      help='Number of records in each chunk file of --matches_out (default 1000000)')
+
+  args = parser.parse_args()
+  gsml_filename = args.gsml
+  submitted_filenames = expand_submitted_filenames(args.submitted)
+  token_lookup_filename = args.token_lookup
+  text_dir = args.text_dir
+  csv_out = args.csv_out
+  workers = args.workers
+  stream = args.stream
+  cache = None
+  if args.cache != None:
+    cache = result_cache.ResultCache(args.cache, int(args.cache_max_mb * 1024 * 1024))
+  # The match records are written as the submissions are scored
+  matches_dirs = None
+  matches_writers = None
+  if args.matches_out != None:
+    matches_dirs = [args.matches_out]
+    if len(submitted_filenames) > 1:
+      matches_dirs = match_export.submission_dirs(args.matches_out, submitted_filenames)
+    matches_writers = [match_export.MatchWriter(d, args.matches_chunk_rows) for d in matches_dirs]
+  profile_out = args.profile
+  bootstrap_replicates = args.bootstrap
+  if args.bootstrap_baseline != None and bootstrap_replicates <= 0:
+    raise Exception('--bootstrap_baseline needs --bootstrap')
+  if bootstrap_replicates > 0 and (workers > 1 or stream or args.cache != None):
+    raise Exception('--bootstrap scores each submission in one process, in memory, it cannot be used with --workers, --stream or --cache')
+
+  print('\n\n')
+  print('-' * 80)
+  print('GSML: EVALUATE')
+
+  # Check all catogories combined, as well as each category individually
+  categories_list = default_categories_list()
+  csv_lines = [
     [
-      '|'.join(categories),
-      str(recall),
-      str(precision),
-      str(token_recall),
-      str(token_precision),
-      submitted_filename,
-      gsml_filename,
-      text_dir,
+      'categories',
+      'recall',
+      'precision',
+      'token_recall',
+      'token_precision',
+      'submitted_filename',
+      'gsml_filename',
+      'token_lookup_filename',
+      'text_dir',
     ]
-  )
+  ]
+  if bootstrap_replicates > 0:
+    csv_lines[0].extend(f'{metric}_{end}' for metric in bootstrap.METRICS for end in ['lower', 'upper'])
 
-  print(f'\tsummary: recall => {recall}, precision => {precision}, token_recall => {token_recall}, token_precision => {token_precision}')
-  print('\tbreakdown:')
-  for k, v in result.items():
-    print(f'\t\t{k}')
-    for sub_k, sub_v in v.items():
-      print(f'\t\t\t{sub_k} => {sub_v}')
-
-if csv_out != None:
-  with open(csv_out, 'w') as fh:
-    s = '\n'.join([','.join(arr) for arr in csv_lines])
-    fh.write(f'{s}\n')
+  # Load the token lookup, and read and check the GSML once, however many submissions there are
+  if text_dir != None:
+    print('\tChecking GSML for token match against raw texts:')
+  with profiling.profiling() if profile_out != None else contextlib.nullcontext() as profile:
+    evaluator = Evaluator(gsml_filename, token_lookup_filename, text_dir, categories_list)
+
+    # Parse and check each submission once, then score every list of categories
+    all_intervals = [None] * len(submitted_filenames)
+    all_paired = [None] * len(submitted_filenames)
+    if bootstrap_replicates > 0:
+      # The results are summed from the counts of each text, which are then resampled
+      all_results = []
+      baseline_per_text = None
+      if args.bootstrap_baseline != None:
+        baseline_per_text = evaluator.count_per_text(args.bootstrap_baseline, categories_list)
+      for k, submitted_filename in enumerate(submitted_filenames):
+        per_text = evaluator.count_per_text(submitted_filename, categories_list, matches_writers and matches_writers[k])
+        all_results.append([get_result(counts) for counts in merge_counts_lists(list(per_text.values()))])
+        with profiling.stage('bootstrap'):
+          all_intervals[k] = bootstrap.bootstrap_results(per_text, bootstrap_replicates, args.confidence, args.seed)
+          if baseline_per_text != None:
+            all_paired[k] = bootstrap.paired_bootstrap(baseline_per_text, per_text, bootstrap_replicates, args.confidence, args.seed)
+    else:
+      all_results = evaluator.score_files(submitted_filenames, categories_list, workers, stream, cache, matches_writers)
+  if cache != None:
+    cache.close()
+  if matches_writers != None:
+    for writer in matches_writers:
+      writer.close()
+
+  for submitted_filename, results, intervals, paired in zip(submitted_filenames, all_results, all_intervals, all_paired):
+    print(f'comparing GSML => "{gsml_filename}" to submission => "{submitted_filename}"')
+    if text_dir != None:
+      print('\tChecking Submitted for token match against raw texts:')
+
+    for k, (categories, result) in enumerate(zip(categories_list, results)):
+      category_display_str = ', '.join(categories)
+      print('\n\n--------------------------------------------')
+      print(f'-- GSML for categories: [{category_display_str}]')
+
+      recall = format_result_value(result['recall']['value'])
+      precision = format_result_value(result['precision']['value'])
+      token_recall = format_result_value(result['token_recall']['value'])
+      token_precision = format_result_value(result['token_precision']['value'])
+
+      csv_lines.append(
+        [
+          '|'.join(categories),
+          str(recall),
+          str(precision),
+          str(token_recall),
+          str(token_precision),
+          submitted_filename,
+          gsml_filename,
+          str(token_lookup_filename),
+          str(text_dir),
+        ]
+      )
+      if intervals != None:
+        csv_lines[-1].extend(str(format_difference(x[end])) for x in intervals[k].values() for end in ['lower', 'upper'])
+
+      print(f'\tsummary: recall => {recall}, precision => {precision}, token_recall => {token_recall}, token_precision => {token_precision}')
+      if intervals != None:
+        interval_strs = [f'{metric} => [{format_difference(x["lower"])}, {format_difference(x["upper"])}]' for metric, x in intervals[k].items()]
+        print(f'\tbootstrap {args.confidence:.0%} intervals: {", ".join(interval_strs)}')
+      if paired != None:
+        paired_strs = [
+          f'{metric} => {format_difference(x["difference"])} [{format_difference(x["lower"])}, {format_difference(x["upper"])}] p={format_difference(x["p_value"])}'
+          for metric, x in paired[k].items()
+        ]
+        print(f'\tpaired bootstrap vs "{args.bootstrap_baseline}": {", ".join(paired_strs)}')
+      print('\tbreakdown:')
+      for k, v in result.items():
+        print(f'\t\t{k}')
+        for sub_k, sub_v in v.items():
+          print(f'\t\t\t{sub_k} => {sub_v}')
+
+    if len(submitted_filenames) > 1:
+      print('\n')
+
+  if matches_writers != None:
+    for submitted_filename, matches_dir, writer in zip(submitted_filenames, matches_dirs, matches_writers):
+      record_strs = [f'{record} => {n}' for record, n in writer.counts.items()]
+      print(f'Wrote match records for "{submitted_filename}" to {matches_dir}: {", ".join(record_strs)}')
+
+  if csv_out != None:
+    with open(csv_out, 'w') as fh:
+      s = '\n'.join([','.join(arr) for arr in csv_lines])
+      fh.write(f'{s}\n')
+
+  if profile_out != None:
+    with open(profile_out, 'w') as fh:
+      json.dump({
+        'profile': profile.to_dict(),
+        'results': [
+          {
+            'submitted_filename': submitted_filename,
+            'results': [{'categories': categories, **result} for categories, result in zip(categories_list, results)],
+          }
+          for submitted_filename, results in zip(submitted_filenames, all_results)
+        ],
+      }, fh, indent=2)
+
+
+if __name__ == '__main__':
+  main()
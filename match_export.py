@@ -0,0 +1,160 @@
+import csv
+import glob
+import os
+from bisect import bisect_left
+
+"""
+  Per-mistake match records for error analysis, written as submissions are scored (see
+    evaluate.write_match_records())
+
+  One record is written for every GSML mistake, with the submitted mistake which recalled it (if any),
+    and one for every submitted mistake which was not consumed by a GSML mistake:
+  - MATCH: a GSML mistake and the submission which recalled it
+  - MISSED: a GSML mistake which no submission recalled
+  - UNMATCHED: a submission which recalled no GSML mistake (it may still overlap one which an earlier
+    submission consumed, OVERLAP_TOKENS says how many GSML tokens it covers)
+
+  The records are CSV, written in batches and split into chunk files of at most chunk_rows records
+    (part-00000.csv, part-00001.csv, ... each with the header), so a directory of them can be loaded
+    like any partitioned dataset:
+
+    pandas.concat(pandas.read_csv(f) for f in sorted(glob.glob('matches/part-*.csv')))
+"""
+
+HEADER = [
+  'RECORD',
+  'TEXT_ID',
+  'GSML_ANNOTATION_ID',
+  'GSML_DOC_TOKEN_START',
+  'GSML_DOC_TOKEN_END',
+  'GSML_TYPE',
+  'GSML_TOKENS',
+  'SUBMITTED_ANNOTATION_ID',
+  'SUBMITTED_DOC_TOKEN_START',
+  'SUBMITTED_DOC_TOKEN_END',
+  'SUBMITTED_TYPE',
+  'SUBMITTED_TOKENS',
+  'OVERLAP_TOKENS',
+]
+
+MATCH = 'MATCH'
+MISSED = 'MISSED'
+UNMATCHED = 'UNMATCHED'
+
+''' Returns the number of tokens two spans (doc token ids, including both ends) have in common '''
+def overlap_tokens(start_idx, end_idx, other_start_idx, other_end_idx):
+  return max(0, min(end_idx, other_end_idx) - max(start_idx, other_start_idx) + 1)
+
+''' Returns the record columns of a Mistake, or empty columns for None '''
+def mistake_columns(mistake):
+  if mistake is None:
+    return ['', '', '', '', '']
+  return [mistake.annotation_id, mistake.doc_start_idx, mistake.doc_end_idx, mistake.category, mistake.tokens]
+
+"""
+  Returns the records of one text, from the result of evaluate.match_text()
+  GSML mistakes come first, in GSML order, then the unconsumed submissions in file order.
+"""
+def text_records(text_id, matches, unconsumed):
+  records = []
+  for gsml_error_data, submitted_error_data in matches:
+    if submitted_error_data is None:
+      records.append([MISSED, text_id] + mistake_columns(gsml_error_data) + mistake_columns(None) + [0])
+      continue
+    overlap = overlap_tokens(
+      gsml_error_data.doc_start_idx, gsml_error_data.doc_end_idx,
+      submitted_error_data.doc_start_idx, submitted_error_data.doc_end_idx,
+    )
+    records.append([MATCH, text_id] + mistake_columns(gsml_error_data) + mistake_columns(submitted_error_data) + [overlap])
+
+  # The GSML spans cannot overlap, so sorted by start they are also sorted by end, and the ones a
+  # submission overlaps are a contiguous run found by binary search on the ends (as in evaluate.use_span())
+  gsml_spans = sorted((m.doc_start_idx, m.doc_end_idx) for m, _ in matches if m.doc_end_idx >= m.doc_start_idx)
+  ends = [end_idx for _, end_idx in gsml_spans]
+  for submitted_error_data in unconsumed:
+    start_idx = submitted_error_data.doc_start_idx
+    end_idx = submitted_error_data.doc_end_idx
+    overlap = 0
+    pos = bisect_left(ends, start_idx)
+    while pos < len(gsml_spans) and gsml_spans[pos][0] <= end_idx:
+      overlap += overlap_tokens(gsml_spans[pos][0], gsml_spans[pos][1], start_idx, end_idx)
+      pos += 1
+    records.append([UNMATCHED, text_id] + mistake_columns(None) + mistake_columns(submitted_error_data) + [overlap])
+  return records
+
+"""
+  Returns the directory in out_dir to export each submission to, when there are several
+  These are the submissions' paths (without the .csv) relative to the directory they have in common,
+    so submissions with the same filename in different directories are kept apart.
+"""
+def submission_dirs(out_dir, submitted_filenames):
+  paths = [os.path.splitext(os.path.abspath(f))[0] for f in submitted_filenames]
+  common = os.path.commonpath([os.path.dirname(p) for p in paths])
+  return [os.path.join(out_dir, os.path.relpath(p, common)) for p in paths]
+
+"""
+  Writes records to chunk files in out_dir (created if needed).
+  Records are buffered and written batch_rows at a time, and a new chunk file is started every
+    chunk_rows records, so neither the records nor one file has to fit in memory.
+  Any chunk files already in out_dir (from an earlier export) are deleted first.
+"""
+class MatchWriter:
+  def __init__(self, out_dir, chunk_rows=1000000, batch_rows=10000):
+    self.out_dir = out_dir
+    self.chunk_rows = chunk_rows
+    self.batch_rows = batch_rows
+    self.filenames = []
+    self.counts = {MATCH: 0, MISSED: 0, UNMATCHED: 0}
+    self._batch = []
+    self._fh = None
+    self._writer = None
+    self._chunk_written = 0
+    os.makedirs(out_dir, exist_ok=True)
+    # Chunks left by an earlier export would be read as part of this one
+    for filename in glob.glob(os.path.join(out_dir, 'part-*.csv')):
+      os.remove(filename)
+
+  def _open_chunk(self):
+    filename = os.path.join(self.out_dir, f'part-{len(self.filenames):05d}.csv')
+    self.filenames.append(filename)
+    self._fh = open(filename, 'w', newline='')
+    self._writer = csv.writer(self._fh, lineterminator='\n')
+    self._writer.writerow(HEADER)
+    self._chunk_written = 0
+
+  def _flush(self):
+    batch = self._batch
+    while batch:
+      if self._fh is None or self._chunk_written >= self.chunk_rows:
+        self._close_chunk()
+        self._open_chunk()
+      n = self.chunk_rows - self._chunk_written
+      self._writer.writerows(batch[:n])
+      self._chunk_written += len(batch[:n])
+      batch = batch[n:]
+    self._batch = []
+
+  def _close_chunk(self):
+    if self._fh != None:
+      self._fh.close()
+      self._fh = None
+
+  def write(self, records):
+    for record in records:
+      self.counts[record[0]] += 1
+    self._batch.extend(records)
+    if len(self._batch) >= self.batch_rows:
+      self._flush()
+
+  ''' Writes the remaining records, there is always at least one chunk file (with only the header when there were no records) '''
+  def close(self):
+    self._flush()
+    if not self.filenames:
+      self._open_chunk()
+    self._close_chunk()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
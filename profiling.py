@@ -0,0 +1,124 @@
+import contextlib
+import time
+import tracemalloc
+
+"""
+  Per-stage timing and memory instrumentation for evaluate.py
+
+  The pipeline marks its stages with `with profiling.stage('read_gsml'):`.  Nothing is recorded unless
+    a profile is active, in which case each stage gets its number of calls, total wall time and peak
+    allocation (tracemalloc, in bytes above what was allocated when the stage started):
+
+    with profiling.profiling() as profile:
+      results = evaluator.score_file('submission.csv')
+    print(profile.to_dict())
+
+  Stages nest, and are named by their path, e.g. 'read_gsml/check_raw_tokens'.  A parent's time and
+    peak include its children's.
+  When no profile is active, stage() returns one shared no-op context manager, so the cost is a
+    function call per stage.
+"""
+
+_active = None
+_NULL_STAGE = contextlib.nullcontext()
+
+''' Returns a context manager which records a stage in the active profile (if any) '''
+def stage(name):
+  if _active is None:
+    return _NULL_STAGE
+  return _active.stage(name)
+
+''' Returns the active Profile, or None '''
+def active():
+  return _active
+
+class Profile:
+  def __init__(self, memory=True):
+    self.memory = memory
+    self.stages = {}
+    self._stack = []
+    # [allocated at the start, peak so far] of each open stage, when tracing memory
+    self._frames = []
+
+  def _raise_peaks(self, peak):
+    for frame in self._frames:
+      frame[1] = max(frame[1], peak)
+
+  @contextlib.contextmanager
+  def stage(self, name):
+    self._stack.append(name)
+    path = '/'.join(self._stack)
+    if self.memory:
+      current, peak = tracemalloc.get_traced_memory()
+      # The peak is reset for this stage, so the open stages keep what it was
+      self._raise_peaks(peak)
+      tracemalloc.reset_peak()
+      self._frames.append([current, current])
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      entry = self.stages.setdefault(path, {'calls': 0, 'seconds': 0.0, 'peak_bytes': None})
+      entry['calls'] += 1
+      entry['seconds'] += time.perf_counter() - start
+      if self.memory:
+        _, peak = tracemalloc.get_traced_memory()
+        self._raise_peaks(peak)
+        start_bytes, peak_bytes = self._frames.pop()
+        entry['peak_bytes'] = max(entry['peak_bytes'] or 0, peak_bytes - start_bytes)
+      self._stack.pop()
+
+  ''' Adds the stages of another profile (as from to_dict()), e.g. one recorded in a worker process '''
+  def merge(self, other, prefix=None):
+    for path, other_entry in other['stages'].items():
+      if prefix:
+        path = f'{prefix}/{path}'
+      entry = self.stages.setdefault(path, {'calls': 0, 'seconds': 0.0, 'peak_bytes': None})
+      entry['calls'] += other_entry['calls']
+      entry['seconds'] += other_entry['seconds']
+      if other_entry['peak_bytes'] != None:
+        entry['peak_bytes'] = max(entry['peak_bytes'] or 0, other_entry['peak_bytes'])
+
+  def to_dict(self):
+    return {
+      'memory': self.memory,
+      'stages': {path: dict(entry) for path, entry in self.stages.items()},
+    }
+
+"""
+  Makes a new Profile active for the duration of the with block, and yields it.
+  With memory, allocations are traced with tracemalloc (which slows the pipeline down), otherwise
+    only calls and wall time are recorded.
+"""
+@contextlib.contextmanager
+def profiling(memory=True):
+  global _active
+  previous = _active
+  profile = Profile(memory)
+  started_tracing = memory and not tracemalloc.is_tracing()
+  if started_tracing:
+    tracemalloc.start()
+  _active = profile
+  try:
+    yield profile
+  finally:
+    _active = previous
+    if started_tracing:
+      tracemalloc.stop()
+
+"""
+  For a task run in a forked worker: when a profile was active in the parent, the task is recorded in
+    a fresh one (so stages are not counted twice), which is yielded.  Otherwise yields None.
+"""
+@contextlib.contextmanager
+def worker_profile():
+  global _active
+  previous = _active
+  if previous is None:
+    yield None
+    return
+  _active = Profile(previous.memory)
+  try:
+    yield _active
+  finally:
+    _active = previous
@@ -0,0 +1,124 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+"""
+  Persistent cache of per-text scoring counts, for re-running evaluate.py after small changes
+
+  Entries are keyed by a hash of everything the counts for one text depend on (that text's GSML and
+    submitted rows, its slice of the token lookup, the lists of categories, ...), so a text is only
+    re-scored when one of its inputs has changed.  The cache is a single SQLite file; once it grows past
+    max_bytes the least recently used entries are evicted.
+"""
+
+''' Bump this when a change to the scoring would change the counts stored for the same inputs '''
+CACHE_VERSION = 1
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+''' Returns the hex sha256 of a list of parts (str, bytes or anything JSON can encode) '''
+def digest(parts):
+  h = hashlib.sha256()
+  for part in parts:
+    if isinstance(part, str):
+      part = part.encode('utf-8')
+    elif not isinstance(part, (bytes, bytearray, memoryview)):
+      part = json.dumps(part, sort_keys=True).encode('utf-8')
+    # Length prefixed, so the parts cannot run into each other
+    h.update(len(part).to_bytes(8, 'little'))
+    h.update(part)
+  return h.hexdigest()
+
+"""
+  Reads are served from SQLite, but within a run nothing is written until flush(): the new entries and
+    the last_used times of the entries read are buffered, then written in one transaction (with one
+    check of the total size), so a warm run costs one SELECT per text.
+"""
+class ResultCache:
+  def __init__(self, filename, max_bytes=DEFAULT_MAX_BYTES):
+    self.filename = filename
+    self.max_bytes = max_bytes
+    self.hits = 0
+    self.misses = 0
+    self._connection = None
+    self._pid = None
+    # key => JSON value of the entries put since the last flush()
+    self._pending = {}
+    # key => when it was last read, since the last flush()
+    self._used = {}
+
+  ''' Returns a connection for this process (connections cannot be shared with forked workers) '''
+  def connection(self):
+    if self._connection is None or self._pid != os.getpid():
+      self._connection = sqlite3.connect(self.filename, timeout=60)
+      self._pid = os.getpid()
+      # A forked worker starts with nothing buffered, the parent flushes its own
+      self._pending = {}
+      self._used = {}
+      self._connection.execute(
+        'CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT, size INTEGER, last_used REAL)'
+      )
+      self._connection.execute('CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)')
+      self._connection.commit()
+    return self._connection
+
+  ''' Returns the value stored for a key, or None '''
+  def get(self, key):
+    connection = self.connection()
+    value = self._pending.get(key)
+    if value is None:
+      row = connection.execute('SELECT value FROM entries WHERE key = ?', (key,)).fetchone()
+      if row is None:
+        self.misses += 1
+        return None
+      value = row[0]
+      self._used[key] = time.time()
+    self.hits += 1
+    return json.loads(value)
+
+  ''' Stores a value (anything JSON can encode), it is written by the next flush() '''
+  def put(self, key, value):
+    self.connection()
+    self._pending[key] = json.dumps(value)
+    self._used.pop(key, None)
+
+  ''' Writes the buffered entries and last_used times in one transaction, then evicts old entries if the cache is too big '''
+  def flush(self):
+    if not self._pending and not self._used:
+      return
+    connection = self.connection()
+    now = time.time()
+    with connection:
+      connection.executemany(
+        'UPDATE entries SET last_used = ? WHERE key = ?',
+        [(last_used, key) for key, last_used in self._used.items()]
+      )
+      connection.executemany(
+        'INSERT OR REPLACE INTO entries (key, value, size, last_used) VALUES (?, ?, ?, ?)',
+        [(key, value, len(key) + len(value), now) for key, value in self._pending.items()]
+      )
+      if self._pending:
+        self.evict(connection)
+    self._pending = {}
+    self._used = {}
+
+  ''' Deletes the least recently used entries until the cache fits in max_bytes '''
+  def evict(self, connection):
+    total = connection.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+    while total > self.max_bytes:
+      oldest = connection.execute('SELECT key, size FROM entries ORDER BY last_used LIMIT 256').fetchall()
+      if not oldest:
+        break
+      for key, size in oldest:
+        connection.execute('DELETE FROM entries WHERE key = ?', (key,))
+        total -= size
+        if total <= self.max_bytes:
+          break
+
+  def close(self):
+    if self._connection is not None and self._pid == os.getpid():
+      self.flush()
+      self._connection.close()
+    self._connection = None
@@ -1,16 +1,22 @@
 import csv
-import json
 import glob
+import pickle
+
+from box_score_store import BoxScoreStore
+from text_store import get_text_store
+import evaluate
+import webanno
 
 import pprint
 pp = pprint.PrettyPrinter(indent=4)
 
-# Check the details in games.csv match those in the JSON
-with open('games.csv', newline='') as csvfile, open('shared_task.jsonl') as fh:
-  json_lines = []
+# Every check below reads the texts through one store, so each file is only read once
+texts_store = get_text_store('texts')
 
-  for line in fh.readlines():
-    json_lines.append(json.loads(line))
+# Check the details in games.csv match those in the JSON
+box_scores = BoxScoreStore('shared_task.jsonl')
+with open('games.csv', newline='') as csvfile:
+  json_text_ids = box_scores.text_ids()
 
   reader = csv.reader(csvfile, delimiter=',', quotechar='"')
   next(reader, None)
@@ -25,32 +31,30 @@ with open('games.csv', newline='') as csvfile, open('shared_task.jsonl') as fh:
     the_date = row[6]
     
     # Check vs JSON data
-    json_line = json_lines[i]
-
-    if text_id != json_line['shared_task_text_id']:
+    if text_id != json_text_ids[i]:
       raise Exception('TEXT_IDs do not match')
 
-    if home_name != json_line['home_name']:
+    game = box_scores[text_id]
+
+    if home_name != game.home_name:
       raise Exception('Home team names do not match')
 
-    if vis_name != json_line['vis_name']:
+    if vis_name != game.vis_name:
       raise Exception('Visiting team names do not match')
 
-    if the_date != json_line['day']:
+    if the_date != game.day:
       raise Exception('The dates do not match')
 
     # Check that the GENERATED_TEXT column matches the files in /texts
-    with open(f'texts/{text_id}.txt', 'r') as fh_t:
-      text_from_file = fh_t.read().strip()
-      if text_from_file != generated_text:
-        print(text_from_file)
-        print(generated_text)
-        raise Exception('The CSV and files texts do not match')
+    text_from_file = texts_store.text(text_id).strip()
+    if text_from_file != generated_text:
+      print(text_from_file)
+      print(generated_text)
+      raise Exception('The CSV and files texts do not match')
 
 
 # Validate the GSML:
 # - make sure that the tokens in the GSML match the tokens found at the respective positions in raw text
-texts = {}
 matches = 0
 with open('gsml.csv', newline='') as csvfile:
   # Setup the CSV reader and skip the headers
@@ -62,20 +66,17 @@ with open('gsml.csv', newline='') as csvfile:
     text_id = row[0]
     target = row[3]
 
-    # WebAnno IDs start at 1 not 0 like the python lists used to check here
-    start = int(row[6]) - 1
+    # WebAnno IDs start at 1, as do the store's
+    start = int(row[6])
     end = int(row[7])
 
-    with open(f'texts/{text_id}', 'r') as fh_t:
-      if text_id not in texts:
-        texts[text_id] = fh_t.read().split()
-      found = ' '.join(texts[text_id][start:end])
-      if found != target:
-        ex_str = f'No MATCH {text_id}, {i}, {start}, {end}, "{found}", "{target}"'
-        raise Exception(ex_str)
-      else:
-        print(f'matched ({text_id}): {found} == {target}')
-        matches += 1
+    found = texts_store.span(text_id, start, end)
+    if found != target:
+      ex_str = f'No MATCH {text_id}, {i}, {start}, {end}, "{found}", "{target}"'
+      raise Exception(ex_str)
+    else:
+      print(f'matched ({text_id}): {found} == {target}')
+      matches += 1
         
 print(f'{matches} lines matched, all token spans have been found in the source text files.')
 
@@ -96,64 +97,53 @@ with open('games.csv', newline='') as csvfile:
     text_id = row[0][:4]
     # These are excluded for now because they include " characters as tokens which is breaking the CSV reader
     
-    # Load the text from the file
-    with open(f'texts/{text_id}.txt') as text_fh:
-      text = text_fh.read().strip().replace('\n', '') + ' END'
-      sentences = [sentence_to_tokens(s) for s in text.split('.')]
-
-      sentence_lookup = {}
-
-      for sentence_id, sentence in enumerate(sentences):
-        sentence_lookup[sentence_id+1] = {i+1:t for i,t in enumerate(sentence)}
-        period_chars = [(i,t) for i, t in enumerate(sentence) if t == '.']
-        for c in period_chars:
-          # Check that period characters are only ever the last element of a sentence
-          if not (c[1] == '.' and (c[0]+1) == len(sentence)):
-            raise Exception(f'Non-ending period char {text_id}, {c[0]} for sentence {sentence_id}')
-
-        # Check the last element for each sentence is a period character
-        if period_chars[-1][1] != '.':
-          raise Exception(f'Ending char not period for {text_id}, {c[1]} for sentence {sentence_id}')
-
-      # Now check if the sentences by the period split, are the same as the sentences in WebAnno
-      # - Note that WebAnno indexes from 1
-      glob_text = f'curation/{text_id}*/*.tsv'
-      print(glob_text)
-      # pp.pprint(sentence_lookup)
-      for webanno_filename in sorted(glob.glob(glob_text)):
-        print(webanno_filename)
-        with open (webanno_filename,'r') as webanno_fh:
-          webanno_reader = csv.reader(webanno_fh, delimiter='\t', quotechar=None)
-          next(webanno_fh) # skip first row
-          for webanno_row in webanno_reader:
-            if len(webanno_row) > 0:
-              if webanno_row[0][0] != '#':
-                ids = [int(x) for x in webanno_row[0].split('-')]
-                sentence_id, token_id = ids[0], ids[1]
-                # We used the special token 000 (which does not appear in the corpus) to
-                #   replace apostrophes for loading into WebAnno, as it was splitting them
-                #   into sep tokens.  These should not be in the texts folder, but will be in WebAnno data:
-                replacements = {
-                  '000':  "'",
-                  'NULL': 'N/A',
-                  'COLON': ':',
-                }
-
-                webanno_token_text = webanno_row[2]
-
-                for rep_from, rep_to in replacements.items():
-                  if rep_from in sentence_lookup[sentence_id][token_id]:
-                    ext_str =f'{rep_from} character found {sentence_lookup[sentence_id][token_id]}'
-                    print(ext_str)
-                    raise Exception(ext_str)
-
-                  webanno_token_text = webanno_token_text.replace(rep_from, rep_to)
-
-                sentence_token_text = sentence_lookup[sentence_id][token_id]
-                if webanno_token_text != sentence_token_text:
-                  print(webanno_row)
-                  raise Exception(f'Invalid token for {text_id} for sentence {sentence_id}, got {sentence_token_text}, expected {webanno_token_text}')
-                else:
-                  token_matches += 1
-
-print(f'There were {token_matches} token matches between period splitting and WebAnno.')
\ No newline at end of file
+    # Load the text from the store
+    text = texts_store.text(text_id).strip().replace('\n', '') + ' END'
+    sentences = [sentence_to_tokens(s) for s in text.split('.')]
+
+    sentence_lookup = {}
+
+    for sentence_id, sentence in enumerate(sentences):
+      sentence_lookup[sentence_id+1] = {i+1:t for i,t in enumerate(sentence)}
+      period_chars = [(i,t) for i, t in enumerate(sentence) if t == '.']
+      for c in period_chars:
+        # Check that period characters are only ever the last element of a sentence
+        if not (c[1] == '.' and (c[0]+1) == len(sentence)):
+          raise Exception(f'Non-ending period char {text_id}, {c[0]} for sentence {sentence_id}')
+
+      # Check the last element for each sentence is a period character
+      if period_chars[-1][1] != '.':
+        raise Exception(f'Ending char not period for {text_id}, {c[1]} for sentence {sentence_id}')
+
+    # Now check if the sentences by the period split, are the same as the sentences in WebAnno
+    # - Note that WebAnno indexes from 1
+    glob_text = f'curation/{text_id}*/*.tsv'
+    print(glob_text)
+    # pp.pprint(sentence_lookup)
+    for webanno_filename in sorted(glob.glob(glob_text)):
+      print(webanno_filename)
+      # The tokens come back with the 000 / NULL / COLON replacements already undone
+      for sentence_id, token_id, webanno_token_text in webanno.read_curation(webanno_filename).tokens:
+        sentence_token_text = sentence_lookup[sentence_id][token_id]
+
+        # These should not be in the texts folder, but will be in WebAnno data
+        for rep_from in webanno.REPLACEMENTS:
+          if rep_from in sentence_token_text:
+            ext_str =f'{rep_from} character found {sentence_token_text}'
+            print(ext_str)
+            raise Exception(ext_str)
+
+        if webanno_token_text != sentence_token_text:
+          print((sentence_id, token_id, webanno_token_text))
+          raise Exception(f'Invalid token for {text_id} for sentence {sentence_id}, got {sentence_token_text}, expected {webanno_token_text}')
+        else:
+          token_matches += 1
+
+print(f'There were {token_matches} token matches between period splitting and WebAnno.')
+# Check that validation errors survive being sent back from evaluate.py's scoring workers (which pickles them)
+for violations in [['Token 190 already used, duplicate on S008:78'], [f'problem {i}' for i in range(30)]]:
+  invalid = evaluate.InvalidMistakeList('submission.csv', violations)
+  unpickled = pickle.loads(pickle.dumps(invalid))
+  if str(unpickled) != str(invalid) or unpickled.violations != violations or unpickled.source != 'submission.csv':
+    raise Exception(f'InvalidMistakeList does not round trip through pickle: {unpickled!r}')
+print('Validation errors can be pickled.')
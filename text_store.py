@@ -0,0 +1,83 @@
+import os
+
+"""
+  Shared store of the raw texts (texts/*.txt, test_set/texts/*.txt) and their tokens
+
+  Each file is read and split into tokens the first time it is needed in a process, then served from
+    memory, so evaluate.py and test_gsml.py can look up tokens and spans as often as they like.
+  The texts are not expected to change while a process runs, they are never re-read.
+  The texts are already tokenized and joined by single spaces, so the tokens are text.split(), and
+    document token ids start at 1 (they come from WebAnno).
+"""
+
+''' Returns the TEXT_ID for a text id or filename (S001 or S001.txt) '''
+def normalize_text_id(text_id):
+  return text_id[:-4] if text_id.endswith('.txt') else text_id
+
+'''
+  The raw texts in one directory.
+  It can be used like a read-only dict of TEXT_ID => tokens (e.g. by evaluate.check_raw_tokens()).
+'''
+class TextStore:
+  def __init__(self, text_dir):
+    self.text_dir = text_dir
+    self._entries = {}
+
+  ''' Returns the TEXT_IDs of the texts in the directory, in order '''
+  def text_ids(self):
+    return sorted(normalize_text_id(f) for f in os.listdir(self.text_dir) if f.endswith('.txt'))
+
+  def filename(self, text_id):
+    return os.path.join(self.text_dir, f'{normalize_text_id(text_id)}.txt')
+
+  def _entry(self, text_id):
+    text_id = normalize_text_id(text_id)
+    entry = self._entries.get(text_id)
+    if entry is None:
+      entry = self._load(text_id)
+    return entry
+
+  def _load(self, text_id):
+    with open(self.filename(text_id), 'r') as fh:
+      text = fh.read()
+    entry = (text, text.split())
+    self._entries[text_id] = entry
+    return entry
+
+  ''' Loads the texts which have a file, and have not been loaded yet, returns the store '''
+  def preload(self, text_ids):
+    for text_id in text_ids:
+      text_id = normalize_text_id(text_id)
+      if text_id not in self._entries and os.path.exists(self.filename(text_id)):
+        self._load(text_id)
+    return self
+
+  ''' Returns the raw text, as in the file '''
+  def text(self, text_id):
+    return self._entry(text_id)[0]
+
+  ''' Returns the list of tokens '''
+  def tokens(self, text_id):
+    return self._entry(text_id)[1]
+
+  ''' Returns the tokens from document token id start to end (inclusive, starting at 1), joined by spaces '''
+  def span(self, text_id, start, end):
+    return ' '.join(self.tokens(text_id)[start-1:end])
+
+  def __getitem__(self, text_id):
+    try:
+      return self.tokens(text_id)
+    except FileNotFoundError:
+      raise KeyError(text_id)
+
+  def __contains__(self, text_id):
+    return normalize_text_id(text_id) in self._entries or os.path.exists(self.filename(text_id))
+
+_stores = {}
+
+''' Returns the TextStore for a directory, shared by everything in this process '''
+def get_text_store(text_dir):
+  key = os.path.abspath(text_dir)
+  if key not in _stores:
+    _stores[key] = TextStore(text_dir)
+  return _stores[key]
@@ -0,0 +1,408 @@
+import argparse
+import array
+import collections
+import hashlib
+import json
+import mmap
+import os
+import sys
+import yaml
+
+"""
+  Compiled form of token_lookup.yaml
+
+  Parsing the YAML takes several seconds, so it is compiled once into a binary file which
+    can be memory-mapped and is ready to use in milliseconds.
+  The file is laid out as:
+  - MAGIC, the length of the JSON header (uint32), the JSON header, padding to 4 bytes
+  - a flat array of int32 values
+  The header records the sha256 of the YAML it was built from, so a stale index is detected
+    and rebuilt.  For each TEXT_ID the header gives [offset, num_tokens, num_sentences], where
+    offset is the position in the int32 array of that text's tables:
+  - doc_sentence (num_tokens):      sentence_id of each document token
+  - sent_start (num_sentences + 1): number of document tokens before each sentence, then num_tokens
+  All ids start at 1 (they come from WebAnno), so document token d is found at position d-1.
+  A sentence is a run of consecutive document tokens, so both conversions are arithmetic: document
+    token d is token d - sent_start[s-1] of its sentence s, and token t of sentence s is document
+    token sent_start[s-1] + t.
+
+  The same tables can be derived from the raw texts alone (see index_from_texts()), as the texts are
+    tokenized and every '.' token ends a sentence (which test_gsml.py checks against WebAnno).
+"""
+
+MAGIC = b'TLIDX002'
+HEADER_LEN_BYTES = 4
+
+MANIFEST_FILENAME = 'manifest.json'
+''' Number of texts a ShardedTokenIndex keeps loaded '''
+DEFAULT_MAX_SHARDS = 256
+
+''' Returns the sha256 (hex) of a file '''
+def source_hash(filename):
+  h = hashlib.sha256()
+  with open(filename, 'rb') as fh:
+    for chunk in iter(lambda: fh.read(1 << 20), b''):
+      h.update(chunk)
+  return h.hexdigest()
+
+''' Returns the path the compiled index for a token lookup YAML is kept at '''
+def default_index_path(yaml_filename):
+  root, _ = os.path.splitext(yaml_filename)
+  return f'{root}.idx'
+
+''' Returns the directory the shards of a token lookup YAML are kept in '''
+def default_shard_dir(yaml_filename):
+  root, _ = os.path.splitext(yaml_filename)
+  return f'{root}.shards'
+
+''' Returns the path of a text's shard '''
+def shard_path(shard_dir, text_id):
+  return os.path.join(shard_dir, f'{text_id}.i32')
+
+''' Returns the number of int32 values in the tables of a text '''
+def text_table_size(num_tokens, num_sentences):
+  return num_tokens + num_sentences + 1
+
+'''
+  Read access to a compiled token lookup.
+  Lookups mirror token_lookup['sent_to_doc'] and token_lookup['doc_to_sent'], and raise KeyError
+    for ids which are not in the lookup, just like the nested dicts did.
+'''
+class TokenIndex:
+  def __init__(self, buffer):
+    if bytes(buffer[:len(MAGIC)]) != MAGIC:
+      raise Exception('Not a compiled token lookup index')
+    header_len = int.from_bytes(buffer[len(MAGIC):len(MAGIC)+HEADER_LEN_BYTES], 'little')
+    header_start = len(MAGIC) + HEADER_LEN_BYTES
+    self.header = json.loads(bytes(buffer[header_start:header_start+header_len]))
+    data_start = padded(header_start + header_len)
+    self._buffer = buffer
+    self._data = memoryview(buffer)[data_start:].cast('i')
+    self._texts = self.header['texts']
+
+  @property
+  def source_sha256(self):
+    return self.header['source_sha256']
+
+  def __contains__(self, text_id):
+    return text_id in self._texts
+
+  def text_ids(self):
+    return list(self._texts.keys())
+
+  def num_tokens(self, text_id):
+    return self._texts[text_id][1]
+
+  def num_sentences(self, text_id):
+    return self._texts[text_id][2]
+
+  """
+    Returns (data, offset, num_tokens, num_sentences) for a text, where offset is the position of its
+      tables (as laid out above) in data
+  """
+  def _tables(self, text_id):
+    offset, num_tokens, num_sentences = self._texts[text_id]
+    return self._data, offset, num_tokens, num_sentences
+
+  ''' Returns (sentence_id, token_id) for a document token id '''
+  def doc_to_sent(self, text_id, doc_idx):
+    data, offset, num_tokens, _ = self._tables(text_id)
+    if doc_idx is None or not 1 <= doc_idx <= num_tokens:
+      raise KeyError(doc_idx)
+    sentence_id = data[offset+doc_idx-1]
+    return sentence_id, doc_idx - data[offset+num_tokens+sentence_id-1]
+
+  ''' Returns the document token id for a token within a sentence '''
+  def sent_to_doc(self, text_id, sentence_id, token_id):
+    data, offset, num_tokens, num_sentences = self._tables(text_id)
+    if sentence_id is None or not 1 <= sentence_id <= num_sentences:
+      raise KeyError(sentence_id)
+    sent_start = offset + num_tokens
+    start = data[sent_start+sentence_id-1]
+    if token_id is None or not 1 <= token_id <= data[sent_start+sentence_id] - start:
+      raise KeyError(token_id)
+    return start + token_id
+
+  ''' Returns the document token ids of a text, in order '''
+  def doc_token_ids(self, text_id):
+    return range(1, self.num_tokens(text_id)+1)
+
+  ''' Returns the bytes of a text's tables, e.g. to tell whether its part of the lookup has changed '''
+  def text_bytes(self, text_id):
+    data, offset, num_tokens, num_sentences = self._tables(text_id)
+    return data[offset:offset+text_table_size(num_tokens, num_sentences)].tobytes()
+
+"""
+  A token lookup split into one file of tables per text (a shard), with a manifest.
+  Only the manifest is read up front, each text's shard is read the first time it is looked up and
+    kept in an LRU of max_texts texts, so memory and start-up time follow the texts a submission
+    touches rather than the size of the corpus.
+  The directory is laid out as:
+  - manifest.json: the format (MAGIC), the sha256 of the YAML it was built from, the byteorder, and for each TEXT_ID
+    [num_tokens, num_sentences]
+  - TEXT_ID.i32: the tables of one text, as laid out above, starting at offset 0
+"""
+class ShardedTokenIndex(TokenIndex):
+  def __init__(self, shard_dir, max_texts=DEFAULT_MAX_SHARDS):
+    with open(os.path.join(shard_dir, MANIFEST_FILENAME), 'r') as fh:
+      self.header = json.load(fh)
+    if self.header.get('format') != MAGIC.decode('ascii') or self.header.get('byteorder') != sys.byteorder:
+      raise Exception(f'The token lookup shards in {shard_dir} were built by another version, or for another byteorder')
+    self.shard_dir = shard_dir
+    self.max_texts = max_texts
+    self.loads = 0
+    self._texts = self.header['texts']
+    self._shards = collections.OrderedDict()
+
+  def _tables(self, text_id):
+    data = self._shards.get(text_id)
+    num_tokens, num_sentences = self._texts[text_id]
+    if data is None:
+      data = self._load_shard(text_id, num_tokens, num_sentences)
+    else:
+      self._shards.move_to_end(text_id)
+    return data, 0, num_tokens, num_sentences
+
+  def _load_shard(self, text_id, num_tokens, num_sentences):
+    data = array.array('i')
+    with open(shard_path(self.shard_dir, text_id), 'rb') as fh:
+      data.frombytes(fh.read())
+    if len(data) != text_table_size(num_tokens, num_sentences):
+      raise Exception(f'The token lookup shard for {text_id} in {self.shard_dir} does not match its manifest')
+    self.loads += 1
+    self._shards[text_id] = data
+    if len(self._shards) > self.max_texts:
+      self._shards.popitem(last=False)
+    return data
+
+  def num_tokens(self, text_id):
+    return self._texts[text_id][0]
+
+  def num_sentences(self, text_id):
+    return self._texts[text_id][1]
+
+''' Rounds a byte offset up so the int32 data that follows it is aligned '''
+def padded(n):
+  return n + (-n % array.array('i').itemsize)
+
+'''
+  Returns the int32 tables of a text (as laid out above) from the sentence_id of each of its document tokens
+  Raises if the sentences are not numbered from 1, in order, with no gaps.
+'''
+def text_tables(text_id, doc_sentence_ids):
+  tables = array.array('i', doc_sentence_ids)
+  sent_start = [0]
+  for doc_idx, sentence_id in enumerate(doc_sentence_ids):
+    if sentence_id == len(sent_start) + 1:
+      sent_start.append(doc_idx)
+    elif sentence_id != len(sent_start):
+      raise Exception(f'The sentences of {text_id} are not in order, document token {doc_idx+1} is in sentence {sentence_id}')
+  if doc_sentence_ids:
+    sent_start.append(len(doc_sentence_ids))
+  tables.extend(sent_start)
+  return tables
+
+''' Returns the sentence_id of each token of a raw text, every '.' token ends a sentence '''
+def sentence_ids_from_tokens(tokens):
+  sentence_ids = []
+  sentence_id = 1
+  for token in tokens:
+    sentence_ids.append(sentence_id)
+    if token == '.':
+      sentence_id += 1
+  return sentence_ids
+
+'''
+  Yields (TEXT_ID, num_tokens, num_sentences, tables) for each text of a loaded token lookup dict (as
+    found in token_lookup.yaml), where tables is an int32 array of the text's tables as laid out above
+  Raises if the lookup does not describe sentences of consecutive document tokens.
+'''
+def iterate_text_tables(token_lookup):
+  for text_id, doc_tokens in token_lookup['doc_to_sent'].items():
+    sentences = token_lookup['sent_to_doc'][text_id]
+    num_tokens = len(doc_tokens)
+    for doc_idx in range(1, num_tokens+1):
+      if doc_idx not in doc_tokens:
+        raise Exception(f'Document token ids for {text_id} are not contiguous, missing {doc_idx}')
+    for sentence_id in range(1, len(sentences)+1):
+      if sentence_id not in sentences:
+        raise Exception(f'Sentence ids for {text_id} are not contiguous, missing {sentence_id}')
+
+    tables = text_tables(text_id, [doc_tokens[x]['sentence_id'] for x in range(1, num_tokens+1)])
+    sent_start = tables[num_tokens:]
+    if len(sent_start) != len(sentences) + 1:
+      raise Exception(f'The sentences of {text_id} in doc_to_sent and sent_to_doc do not match')
+    # Both tables must agree with the arithmetic of the index
+    for doc_idx in range(1, num_tokens+1):
+      sentence_id = doc_tokens[doc_idx]['sentence_id']
+      if doc_tokens[doc_idx]['token_id'] != doc_idx - sent_start[sentence_id-1]:
+        raise Exception(f'Token ids for {text_id} sentence {sentence_id} are not contiguous, at document token {doc_idx}')
+    for sentence_id in range(1, len(sentences)+1):
+      sentence_tokens = sentences[sentence_id]
+      start = sent_start[sentence_id-1]
+      if len(sentence_tokens) != sent_start[sentence_id] - start or any(
+        sentence_tokens.get(token_id) != start + token_id for token_id in range(1, len(sentence_tokens)+1)
+      ):
+        raise Exception(f'Token ids for {text_id} sentence {sentence_id} do not match doc_to_sent')
+    yield text_id, num_tokens, len(sentences), tables
+
+''' Yields (TEXT_ID, num_tokens, num_sentences, tables) for raw texts, see sentence_ids_from_tokens() '''
+def iterate_raw_text_tables(raw_tokens, text_ids):
+  for text_id in text_ids:
+    sentence_ids = sentence_ids_from_tokens(raw_tokens[text_id])
+    yield text_id, len(sentence_ids), sentence_ids[-1] if sentence_ids else 0, text_tables(text_id, sentence_ids)
+
+'''
+  Builds the binary index from the tables of each text (see iterate_text_tables())
+  Returns the bytes of the index file.
+'''
+def compile_tables(texts_tables, source_sha256=None):
+  data = array.array('i')
+  texts = {}
+  for text_id, num_tokens, num_sentences, tables in texts_tables:
+    texts[text_id] = [len(data), num_tokens, num_sentences]
+    data.extend(tables)
+
+  header = json.dumps({
+    'source_sha256': source_sha256,
+    'byteorder': sys.byteorder,
+    'texts': texts,
+  }).encode('utf-8')
+  prefix = MAGIC + len(header).to_bytes(HEADER_LEN_BYTES, 'little') + header
+  return prefix + b'\0' * (padded(len(prefix)) - len(prefix)) + data.tobytes()
+
+'''
+  Builds the binary index from a loaded token lookup dict (as found in token_lookup.yaml)
+  Returns the bytes of the index file.
+'''
+def compile_token_lookup(token_lookup, source_sha256=None):
+  return compile_tables(iterate_text_tables(token_lookup), source_sha256)
+
+'''
+  Returns an in-memory TokenIndex derived from raw texts, without token_lookup.yaml
+  raw_tokens is TEXT_ID => tokens (e.g. a text_store.TextStore).
+'''
+def index_from_texts(raw_tokens, text_ids):
+  return TokenIndex(compile_tables(iterate_raw_text_tables(raw_tokens, text_ids)))
+
+''' Compiles a token lookup YAML file into an index file, returns the bytes written '''
+def build_index(yaml_filename, index_filename=None):
+  index_filename = index_filename or default_index_path(yaml_filename)
+  sha = source_hash(yaml_filename)
+  with open(yaml_filename, 'r') as fh:
+    token_lookup = yaml.load(fh, Loader=getattr(yaml, 'CFullLoader', yaml.FullLoader))
+  compiled = compile_token_lookup(token_lookup, sha)
+  tmp_filename = f'{index_filename}.tmp{os.getpid()}'
+  with open(tmp_filename, 'wb') as fh:
+    fh.write(compiled)
+  os.replace(tmp_filename, index_filename)
+  return compiled
+
+''' Memory-maps an index file, returns a TokenIndex or None if it cannot be used '''
+def open_index(index_filename):
+  try:
+    with open(index_filename, 'rb') as fh:
+      buffer = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+  except (OSError, ValueError):
+    return None
+  try:
+    index = TokenIndex(buffer)
+  except Exception:
+    return None
+  if index.header.get('byteorder') != sys.byteorder:
+    return None
+  return index
+
+'''
+  Returns a TokenIndex for a token lookup YAML file.
+  The compiled index is (re)built when it is missing, or when the YAML has changed since it was built.
+  If the index cannot be written (e.g. a read-only checkout), it is compiled in memory instead.
+'''
+def load_index(yaml_filename, index_filename=None):
+  index_filename = index_filename or default_index_path(yaml_filename)
+  sha = source_hash(yaml_filename)
+  index = open_index(index_filename)
+  if index is not None and index.source_sha256 == sha:
+    return index
+  try:
+    build_index(yaml_filename, index_filename)
+  except OSError:
+    with open(yaml_filename, 'r') as fh:
+      token_lookup = yaml.load(fh, Loader=getattr(yaml, 'CFullLoader', yaml.FullLoader))
+    return TokenIndex(compile_token_lookup(token_lookup, sha))
+  return open_index(index_filename)
+
+'''
+  Splits a token lookup YAML file into shards (see ShardedTokenIndex), returns the manifest
+  The manifest is written last, so a directory left by an interrupted build is never used.
+'''
+def build_shards(yaml_filename, shard_dir=None):
+  shard_dir = shard_dir or default_shard_dir(yaml_filename)
+  sha = source_hash(yaml_filename)
+  with open(yaml_filename, 'r') as fh:
+    token_lookup = yaml.load(fh, Loader=getattr(yaml, 'CFullLoader', yaml.FullLoader))
+  os.makedirs(shard_dir, exist_ok=True)
+  manifest_filename = os.path.join(shard_dir, MANIFEST_FILENAME)
+  if os.path.exists(manifest_filename):
+    os.remove(manifest_filename)
+
+  texts = {}
+  for text_id, num_tokens, num_sentences, tables in iterate_text_tables(token_lookup):
+    with open(shard_path(shard_dir, text_id), 'wb') as fh:
+      fh.write(tables.tobytes())
+    texts[text_id] = [num_tokens, num_sentences]
+
+  manifest = {
+    'format': MAGIC.decode('ascii'),
+    'source_sha256': sha,
+    'byteorder': sys.byteorder,
+    'texts': texts,
+  }
+  tmp_filename = f'{manifest_filename}.tmp{os.getpid()}'
+  with open(tmp_filename, 'w') as fh:
+    json.dump(manifest, fh)
+  os.replace(tmp_filename, manifest_filename)
+  return manifest
+
+'''
+  Returns a ShardedTokenIndex for a token lookup YAML file, or for a directory of shards.
+  For a YAML file, the shards are (re)built when they are missing, or when the YAML has changed since they were built.
+'''
+def load_shards(filename, shard_dir=None, max_texts=DEFAULT_MAX_SHARDS):
+  if os.path.isdir(filename):
+    return ShardedTokenIndex(filename, max_texts)
+  shard_dir = shard_dir or default_shard_dir(filename)
+  try:
+    index = ShardedTokenIndex(shard_dir, max_texts)
+    if index.source_sha256 == source_hash(filename):
+      return index
+  except Exception:
+    pass
+  build_shards(filename, shard_dir)
+  return ShardedTokenIndex(shard_dir, max_texts)
+
+''' Returns the token lookup for a YAML file (see load_index()), or a directory of shards (see load_shards()) '''
+def load_token_lookup(filename):
+  if os.path.isdir(filename):
+    return load_shards(filename)
+  return load_index(filename)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Compile token_lookup.yaml into a binary index for evaluate.py')
+  parser.add_argument('token_lookup', type=str,
+                      help='The tokenization file (YAML)')
+  parser.add_argument('--out', type=str,
+                      help='Path of the index file (defaults to the YAML path with an .idx extension)')
+  parser.add_argument('--shards', action='store_true',
+                      help='Split the lookup into one file per text, loaded as needed, in --out (defaults to the YAML path with a .shards extension)')
+  args = parser.parse_args()
+
+  if args.shards:
+    out = args.out or default_shard_dir(args.token_lookup)
+    manifest = build_shards(args.token_lookup, out)
+    print(f'Wrote {len(manifest["texts"])} shards to {out}')
+  else:
+    out = args.out or default_index_path(args.token_lookup)
+    compiled = build_index(args.token_lookup, out)
+    print(f'Wrote {len(compiled)} bytes to {out}')
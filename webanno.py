@@ -0,0 +1,230 @@
+import argparse
+import csv
+import glob
+import multiprocessing
+import os
+import re
+
+import yaml
+
+"""
+  Reads the WebAnno TSV 3.2 exports in curation/ (one CURATION_USER.tsv per text)
+
+  Each file is read once, line by line, into a CurationDocument with:
+  - the tokens of the text, with their sentence and token ids (as in token_lookup.yaml)
+  - the spans of the error layer (webanno.custom.Errors), with their features (A_Type, B_Correction, ...)
+  From these, gsml_rows() gives the rows of a GSML (as in gsml.csv) and token_lookup_tables() gives the
+    tables in token_lookup.yaml, so both can be regenerated from a new round of annotation:
+
+    python webanno.py --curation_dir=curation --gsml_out=gsml.csv --token_lookup_out=token_lookup.yaml
+"""
+
+''' We replaced these in the texts before loading them into WebAnno (which splits tokens on them) '''
+REPLACEMENTS = {
+  '000':  "'",
+  'NULL': 'N/A',
+  'COLON': ':',
+}
+
+''' Features which are empty in a span are exported as * '''
+EMPTY_FEATURE = '*'
+
+''' A token which is not part of any span has _ in every feature column '''
+NO_ANNOTATION = '_'
+
+GSML_HEADER = ['TEXT_ID', 'SENTENCE_ID', 'ANNOTATION_ID', 'TOKENS', 'SENT_TOKEN_START', 'SENT_TOKEN_END',
+               'DOC_TOKEN_START', 'DOC_TOKEN_END', 'TYPE', 'CORRECTION', 'COMMENT']
+
+# A feature value, with the [n] suffix WebAnno gives the spans of more than one token
+LABEL_PATTERN = re.compile(r'^(.*?)(?:(?<!\\)\[(\d+)\])?$', re.DOTALL)
+# Stacked annotations on one token are separated by an unescaped |
+STACK_PATTERN = re.compile(r'(?<!\\)\|')
+ESCAPE_PATTERN = re.compile(r'\\(.)')
+# Error types are numbered in WebAnno, e.g. 1_NAME
+TYPE_PATTERN = re.compile(r'^\d+_')
+
+''' Returns a WebAnno value with its escapes (e.g. \\_) removed '''
+def unescape(value):
+  return ESCAPE_PATTERN.sub(r'\1', value)
+
+''' Returns the token text as it is in texts/ '''
+def replace_token_text(text):
+  for rep_from, rep_to in REPLACEMENTS.items():
+    text = text.replace(rep_from, rep_to)
+  return text
+
+''' Returns the TEXT_ID for a curation file, from the name of its directory (e.g. S001_01_To_60.txt) '''
+def curation_text_id(filename):
+  return os.path.basename(os.path.dirname(filename)).split('_')[0]
+
+''' One span of the error layer, the doc token ids include both ends '''
+class Span:
+  __slots__ = ('doc_start_idx', 'doc_end_idx', 'features')
+
+  def __init__(self, doc_start_idx, doc_end_idx, features):
+    self.doc_start_idx = doc_start_idx
+    self.doc_end_idx = doc_end_idx
+    self.features = features
+
+"""
+  One curation file.
+  tokens is a list of (sentence_id, token_id, text), in document order, so document token d is tokens[d-1].
+  spans are in order of their first token, features are keyed by the layer's feature names.
+"""
+class CurationDocument:
+  def __init__(self, text_id, feature_names, tokens, spans):
+    self.text_id = text_id
+    self.feature_names = feature_names
+    self.tokens = tokens
+    self.spans = spans
+
+  def token_text(self, doc_start_idx, doc_end_idx):
+    return ' '.join(t[2] for t in self.tokens[doc_start_idx-1:doc_end_idx])
+
+''' Reads a WebAnno TSV 3.2 file with one span layer, returns a CurationDocument '''
+def read_curation(filename, text_id=None):
+  text_id = text_id or curation_text_id(filename)
+  feature_names = None
+  tokens = []
+  spans = []
+  # WebAnno span id => its Span, for spans of more than one token
+  open_spans = {}
+
+  with open(filename, 'r', encoding='utf-8') as fh:
+    for line in fh:
+      line = line.rstrip('\n')
+      if line.startswith('#T_SP='):
+        feature_names = line.split('|')[1:]
+        continue
+      if not line or line[0] == '#':
+        continue
+
+      fields = line.split('\t')
+      ids = fields[0].split('-')
+      if '.' in ids[1]:
+        # Sub-token annotations are not used in our exports
+        continue
+      if feature_names is None:
+        raise Exception(f'No span layer found before the tokens in {filename}')
+      tokens.append((int(ids[0]), int(ids[1]), replace_token_text(fields[2])))
+      doc_idx = len(tokens)
+
+      values = fields[3:3+len(feature_names)]
+      if not values or values[0] == NO_ANNOTATION:
+        continue
+
+      # One list of (label, span id) per feature, with an entry for each stacked annotation
+      stacked = [
+        [LABEL_PATTERN.match(x).groups() for x in STACK_PATTERN.split(value)]
+        for value in values
+      ]
+      for k in range(len(stacked[0])):
+        span_id = stacked[0][k][1]
+        if span_id != None and span_id in open_spans:
+          open_spans[span_id].doc_end_idx = doc_idx
+          continue
+        features = {}
+        for name, labels in zip(feature_names, stacked):
+          value = unescape(labels[k][0])
+          features[name] = '' if value == EMPTY_FEATURE else value
+        span = Span(doc_idx, doc_idx, features)
+        spans.append(span)
+        if span_id != None:
+          open_spans[span_id] = span
+
+  return CurationDocument(text_id, feature_names or [], tokens, spans)
+
+'''
+  Returns the error type of a span, without its WebAnno number (1_NAME => NAME)
+  This is J_Corrected_Type where the curator corrected the annotators' type, otherwise A_Type.
+'''
+def span_type(span):
+  return TYPE_PATTERN.sub('', span.features.get('J_Corrected_Type') or span.features.get('A_Type', ''))
+
+"""
+  Returns the GSML rows (as in gsml.csv, without the header) for the spans of a curation document
+  The annotation ids are numbered from first_annotation_id.
+"""
+def gsml_rows(document, first_annotation_id=1):
+  rows = []
+  for i, span in enumerate(document.spans):
+    sentence_id, sent_start_idx, _ = document.tokens[span.doc_start_idx-1]
+    sent_end_idx = document.tokens[span.doc_end_idx-1][1]
+    rows.append([
+      f'{document.text_id}.txt',
+      str(sentence_id),
+      str(first_annotation_id + i),
+      document.token_text(span.doc_start_idx, span.doc_end_idx),
+      str(sent_start_idx),
+      str(sent_end_idx),
+      str(span.doc_start_idx),
+      str(span.doc_end_idx),
+      span_type(span),
+      span.features.get('B_Correction', ''),
+      span.features.get('C_Comment', ''),
+    ])
+  return rows
+
+''' Returns the tables of token_lookup.yaml (doc_to_sent and sent_to_doc) for curation documents '''
+def token_lookup_tables(documents):
+  doc_to_sent = {}
+  sent_to_doc = {}
+  for document in documents:
+    text_doc_to_sent = doc_to_sent.setdefault(document.text_id, {})
+    text_sent_to_doc = sent_to_doc.setdefault(document.text_id, {})
+    for doc_idx, (sentence_id, token_id, _) in enumerate(document.tokens, 1):
+      text_doc_to_sent[doc_idx] = {'sentence_id': sentence_id, 'token_id': token_id}
+      text_sent_to_doc.setdefault(sentence_id, {})[token_id] = doc_idx
+  return {'doc_to_sent': doc_to_sent, 'sent_to_doc': sent_to_doc}
+
+''' Returns the CURATION_USER.tsv files in a curation directory, in TEXT_ID order '''
+def curation_filenames(curation_dir):
+  return sorted(glob.glob(os.path.join(curation_dir, '*', 'CURATION_USER.tsv')), key=curation_text_id)
+
+''' Reads curation files (in a pool of processes with more than one worker), returns their CurationDocuments in order '''
+def read_curations(filenames, workers=1):
+  if workers <= 1 or len(filenames) <= 1:
+    return [read_curation(f) for f in filenames]
+  with multiprocessing.Pool(workers) as pool:
+    return pool.map(read_curation, filenames)
+
+''' Writes GSML rows (from gsml_rows()) to a CSV file, with the header '''
+def write_gsml(filename, rows):
+  with open(filename, 'w', newline='') as fh:
+    writer = csv.writer(fh, lineterminator='\n')
+    writer.writerow(GSML_HEADER)
+    writer.writerows(rows)
+
+''' Writes token lookup tables (from token_lookup_tables()) as YAML '''
+def write_token_lookup(filename, tables):
+  with open(filename, 'w') as fh:
+    yaml.dump(tables, fh, Dumper=getattr(yaml, 'CSafeDumper', yaml.SafeDumper), default_flow_style=False, sort_keys=False)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Build a GSML and token lookup from WebAnno curation exports')
+  parser.add_argument('--curation_dir', type=str, default='curation',
+                      help='Directory of WebAnno exports, one sub-directory per text (default curation)')
+  parser.add_argument('--gsml_out', type=str,
+                      help='Path of the GSML (CSV) to write')
+  parser.add_argument('--token_lookup_out', type=str,
+                      help='Path of the token lookup (YAML) to write')
+  parser.add_argument('--first_annotation_id', type=int, default=1,
+                      help='ANNOTATION_ID of the first mistake, the rest are numbered on from it (default 1)')
+  parser.add_argument('--workers', type=int, default=1,
+                      help='Number of processes to read the files with (default 1)')
+  args = parser.parse_args()
+
+  documents = read_curations(curation_filenames(args.curation_dir), args.workers)
+  print(f'Read {len(documents)} curation files, {sum(len(d.spans) for d in documents)} mistakes')
+
+  if args.gsml_out:
+    rows = []
+    for document in documents:
+      rows.extend(gsml_rows(document, args.first_annotation_id + len(rows)))
+    write_gsml(args.gsml_out, rows)
+    print(f'Wrote {len(rows)} mistakes to {args.gsml_out}')
+
+  if args.token_lookup_out:
+    write_token_lookup(args.token_lookup_out, token_lookup_tables(documents))
+    print(f'Wrote the token lookup to {args.token_lookup_out}')